@@ -0,0 +1,126 @@
+"""
+Compares the resampling methods against the single-shot nd.zoom used before
+by make_orthogonal. Run it from this folder:
+
+    python benchmark.py --shape 300 512 512 --spacing 0.5 0.5 2.5
+
+With --check the Spline result is compared with nd.zoom on small volumes
+split in slabs that don't divide them evenly.
+"""
+import argparse
+import time
+
+import numpy as np
+import scipy.ndimage as nd
+
+import resample
+
+
+def create_image(shape):
+    z, y, x = np.ogrid[: shape[0], : shape[1], : shape[2]]
+    image = 1000 * np.sin(x / 7.0) * np.cos(y / 11.0) + 500 * np.sin(z / 5.0)
+    return image.astype(np.int16)
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - t0, result
+
+
+def check(budgets=(20000, 60000, 200000)):
+    failed = 0
+    for dz in (13, 33, 40, 57, 77, 90):
+        for zz in (0.5, 0.7, 1.3, 2.0, 2.5, 5.0):
+            shape = (dz, 9, 11)
+            zooms = (zz, 1.2, 0.9)
+            image = create_image(shape)
+            reference = nd.zoom(image, zooms, mode="constant", cval=image.min())
+            for budget in budgets:
+                output = np.zeros_like(reference)
+                resample.resample(image, zooms, output=output, memory_budget=budget)
+                if (output != reference).any():
+                    failed += 1
+                    slices = np.nonzero((output != reference).any((1, 2)))[0]
+                    print(f"{shape} x {zooms}, budget {budget}: slices {slices}")
+
+    # The separable interpolations, also when Z keeps its size, are compared
+    # with a single slab.
+    image = create_image((57, 9, 11))
+    for zooms in ((1.0, 1.2, 0.9), (1.0, 1.0, 1.0), (1.3, 1.0, 1.0)):
+        for interpolation in (resample.LINEAR, resample.CUBIC, resample.LANCZOS):
+            shape = resample.get_output_shape(image.shape, zooms)
+            reference = np.zeros(shape, dtype=image.dtype)
+            resample.resample(
+                image,
+                zooms,
+                output=reference,
+                memory_budget=10 ** 9,
+                interpolation=interpolation,
+            )
+            for budget in budgets:
+                output = np.zeros_like(reference)
+                resample.resample(
+                    image,
+                    zooms,
+                    output=output,
+                    memory_budget=budget,
+                    interpolation=interpolation,
+                )
+                if (output != reference).any():
+                    failed += 1
+                    print(f"{interpolation} {zooms}, budget {budget}")
+    print("Check failed" if failed else "Check passed")
+    return failed == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", type=int, nargs=3, default=(200, 512, 512))
+    parser.add_argument("--spacing", type=float, nargs=3, default=(0.5, 0.5, 2.5))
+    parser.add_argument("--workers", type=int, default=resample.WORKERS)
+    parser.add_argument("--skip-zoom", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    if args.check:
+        raise SystemExit(0 if check() else 1)
+
+    image = create_image(args.shape)
+    min_spacing = min(args.spacing)
+    zooms = resample.get_zooms(args.spacing, (min_spacing,) * 3)
+    print(f"Shape: {image.shape}, zooms: {zooms}")
+
+    reference = None
+    if not args.skip_zoom:
+        t, reference = timeit(
+            nd.zoom,
+            image,
+            zooms,
+            output=image.dtype,
+            mode="constant",
+            cval=image.min(),
+        )
+        print(f"nd.zoom: {t:.2f}s")
+
+    for interpolation in resample.INTERPOLATIONS:
+        for workers in sorted({1, args.workers}):
+            t, output = timeit(
+                resample.resample,
+                image,
+                zooms,
+                workers=workers,
+                interpolation=interpolation,
+            )
+            msg = f"{interpolation} ({workers} workers): {t:.2f}s"
+            if reference is not None:
+                diff = np.abs(output.astype(np.int32) - reference).max()
+                msg += f", max diff to nd.zoom: {diff}"
+            print(msg)
+            filename = output.filename
+            del output
+            resample.remove_outputs([filename])
+
+
+if __name__ == "__main__":
+    main()
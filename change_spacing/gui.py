@@ -1,6 +1,28 @@
+import numpy as np
 import wx
+from invesalius.data import imagedata_utils
 from pubsub import pub as Publisher
 
+from . import resample
+
+
+def np2bitmap(arr):
+    height, width = arr.shape
+    arr = imagedata_utils.image_normalize(arr, 0, 255)
+    npimg = np.zeros((height, width, 3), dtype=np.uint8)
+    npimg[:] = arr[:, :, np.newaxis]
+    image = wx.Image(width, height)
+    image.SetData(npimg.tobytes())
+    return image.ConvertToBitmap()
+
+
+def format_bytes(nbytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
 
 class GUIIsotropic(wx.Dialog):
     def __init__(
@@ -19,6 +41,8 @@ class GUIIsotropic(wx.Dialog):
         self.spacing_new_y = 1.0
         self.spacing_new_z = 1.0
 
+        self.matrix = None
+
         self._init_gui()
 
         self.set_original_spacing(
@@ -47,6 +71,46 @@ class GUIIsotropic(wx.Dialog):
         self.txt_spacing_new_y.ChangeValue(str(sy))
         self.txt_spacing_new_z.ChangeValue(str(sz))
 
+        self.update_preview()
+
+    def set_image(self, matrix):
+        self.matrix = matrix
+        self.update_preview()
+
+    def update_preview(self):
+        if self.matrix is None:
+            return
+
+        old_spacing = (
+            self.spacing_original_x,
+            self.spacing_original_y,
+            self.spacing_original_z,
+        )
+        new_spacing = (self.spacing_new_x, self.spacing_new_y, self.spacing_new_z)
+        if min(new_spacing) <= 0:
+            return
+
+        zooms = resample.get_zooms(old_spacing, new_spacing)
+        interpolation = self.get_interpolation()
+
+        axial = resample.get_preview(self.matrix, zooms, "AXIAL", interpolation)
+        coronal = resample.get_preview(self.matrix, zooms, "CORONAL", interpolation)
+        self.bmp_axial.SetBitmap(np2bitmap(axial))
+        self.bmp_coronal.SetBitmap(np2bitmap(coronal[::-1]))
+
+        shape, nbytes, runtime = resample.estimate(
+            self.matrix,
+            zooms,
+            interpolation=interpolation,
+            workers=self.spin_workers.GetValue(),
+        )
+        self.txt_shape.SetLabel("{} x {} x {}".format(*shape[::-1]))
+        self.txt_size.SetLabel(format_bytes(nbytes))
+        self.txt_runtime.SetLabel(f"{runtime:.1f} s")
+
+        self.GetSizer().Fit(self)
+        self.Layout()
+
     def _init_gui(self):
         self.txt_spacing_original_x = wx.TextCtrl(self, -1, style=wx.TE_READONLY)
         self.txt_spacing_original_y = wx.TextCtrl(self, -1, style=wx.TE_READONLY)
@@ -56,14 +120,35 @@ class GUIIsotropic(wx.Dialog):
         self.txt_spacing_new_y = wx.TextCtrl(self, -1)
         self.txt_spacing_new_z = wx.TextCtrl(self, -1)
 
+        self.spin_workers = wx.SpinCtrl(
+            self, -1, value=str(resample.WORKERS), min=1, max=resample.WORKERS
+        )
+
+        self.choice_interpolation = wx.Choice(
+            self, -1, choices=list(resample.INTERPOLATIONS)
+        )
+        self.choice_interpolation.SetSelection(0)
+
         self.check_isotropic = wx.CheckBox(self, -1, "Isotropic")
         self.check_isotropic.SetValue(True)
 
+        empty_bitmap = wx.Bitmap(resample.PREVIEW_SIZE, resample.PREVIEW_SIZE)
+        self.bmp_axial = wx.StaticBitmap(self, -1, empty_bitmap)
+        self.bmp_coronal = wx.StaticBitmap(self, -1, empty_bitmap)
+
+        self.txt_shape = wx.StaticText(self, -1, "")
+        self.txt_size = wx.StaticText(self, -1, "")
+        self.txt_runtime = wx.StaticText(self, -1, "")
+
         self.cb_new_inv_instance = wx.CheckBox(
             self, -1, "Launch new InVesalius instance"
         )
         self.cb_new_inv_instance.SetValue(True)
 
+        self.cb_resample_masks = wx.CheckBox(self, -1, "Resample masks")
+        self.cb_resample_masks.SetValue(True)
+        self.cb_resample_masks.Enable(False)
+
         self.button_ok = wx.Button(self, wx.ID_OK)
         self.button_cancel = wx.Button(self, wx.ID_CANCEL)
 
@@ -105,10 +190,47 @@ class GUIIsotropic(wx.Dialog):
         content_sizer.Add(original_sbox, 1, wx.EXPAND | wx.ALL, 5)
         content_sizer.Add(new_sbox, 1, wx.EXPAND | wx.ALL, 5)
 
+        options_sizer = wx.FlexGridSizer(2, 2, 5, 5)
+        options_sizer.AddMany(
+            (
+                (wx.StaticText(self, -1, "Interpolation"), 0, wx.ALIGN_CENTER_VERTICAL),
+                (self.choice_interpolation, 0, wx.EXPAND),
+                (wx.StaticText(self, -1, "Workers"), 0, wx.ALIGN_CENTER_VERTICAL),
+                (self.spin_workers, 0, wx.EXPAND),
+            )
+        )
+
+        preview_images_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        preview_images_sizer.Add(self.bmp_axial, 0, wx.ALL, 5)
+        preview_images_sizer.Add(self.bmp_coronal, 0, wx.ALL, 5)
+
+        estimate_sizer = wx.FlexGridSizer(3, 2, 5, 5)
+        estimate_sizer.AddMany(
+            (
+                (wx.StaticText(self, -1, "Output size"), 0, wx.ALIGN_CENTER_VERTICAL),
+                (self.txt_shape, 0, wx.EXPAND),
+                (wx.StaticText(self, -1, "Memory"), 0, wx.ALIGN_CENTER_VERTICAL),
+                (self.txt_size, 0, wx.EXPAND),
+                (
+                    wx.StaticText(self, -1, "Estimated time"),
+                    0,
+                    wx.ALIGN_CENTER_VERTICAL,
+                ),
+                (self.txt_runtime, 0, wx.EXPAND),
+            )
+        )
+
+        preview_sbox = wx.StaticBoxSizer(wx.VERTICAL, self, "Preview")
+        preview_sbox.Add(preview_images_sizer, 0, wx.EXPAND)
+        preview_sbox.Add(estimate_sizer, 0, wx.EXPAND | wx.ALL, 5)
+
         main_sizer = wx.BoxSizer(wx.VERTICAL)
         main_sizer.Add(content_sizer, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 5)
+        main_sizer.Add(preview_sbox, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 10)
+        main_sizer.Add(options_sizer, 0, wx.ALL | wx.ALIGN_RIGHT, 7)
         main_sizer.Add(self.check_isotropic, 0, wx.RIGHT | wx.ALIGN_RIGHT, 7)
         main_sizer.Add(self.cb_new_inv_instance, 0, wx.RIGHT | wx.ALIGN_RIGHT, 7)
+        main_sizer.Add(self.cb_resample_masks, 0, wx.RIGHT | wx.ALIGN_RIGHT, 7)
         main_sizer.Add(button_sizer, 0, wx.EXPAND | wx.TOP | wx.BOTTOM, 5)
 
         self.SetSizer(main_sizer)
@@ -120,6 +242,10 @@ class GUIIsotropic(wx.Dialog):
         self.txt_spacing_new_y.Bind(wx.EVT_KILL_FOCUS, self.OnSetNewSpacing)
         self.txt_spacing_new_z.Bind(wx.EVT_KILL_FOCUS, self.OnSetNewSpacing)
 
+        self.choice_interpolation.Bind(wx.EVT_CHOICE, self.OnSetOptions)
+        self.spin_workers.Bind(wx.EVT_SPINCTRL, self.OnSetOptions)
+        self.cb_new_inv_instance.Bind(wx.EVT_CHECKBOX, self.OnSetNewInstance)
+
         self.button_ok.Bind(wx.EVT_BUTTON, self.OnOk)
         self.button_cancel.Bind(wx.EVT_BUTTON, self.OnCancel)
 
@@ -154,8 +280,50 @@ class GUIIsotropic(wx.Dialog):
 
             self.set_new_spacing(new_spacing_x, new_spacing_y, new_spacing_z)
 
+    def OnSetOptions(self, evt):
+        self.update_preview()
+
+    def OnSetNewInstance(self, evt):
+        # The masks can't be sent to a new InVesalius instance.
+        self.cb_resample_masks.Enable(not self.cb_new_inv_instance.GetValue())
+
+    def get_interpolation(self):
+        return self.choice_interpolation.GetStringSelection()
+
     def OnOk(self, evt):
         self.EndModal(wx.ID_OK)
 
     def OnCancel(self, evt):
         self.EndModal(wx.ID_CANCEL)
+
+
+class ResampleProgressDialog(wx.ProgressDialog):
+    def __init__(self, parent, worker, on_finished):
+        super().__init__(
+            "Change spacing",
+            "Resampling image",
+            maximum=100,
+            parent=parent,
+            style=wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | wx.PD_REMAINING_TIME,
+        )
+        self.worker = worker
+        self.on_finished = on_finished
+
+        Publisher.subscribe(self.OnProgress, "Change spacing progress")
+        Publisher.subscribe(self.OnFinished, "Change spacing finished")
+
+    def OnProgress(self, done, total):
+        if self.worker.is_cancelled():
+            return
+        keep_going, _skip = self.Update(
+            min(99, int(100 * done / total)), f"Resampled {done} of {total} slabs"
+        )
+        if not keep_going:
+            self.worker.cancel()
+
+    def OnFinished(self):
+        Publisher.unsubscribe(self.OnProgress, "Change spacing progress")
+        Publisher.unsubscribe(self.OnFinished, "Change spacing finished")
+        self.Destroy()
+        if not self.worker.is_cancelled():
+            self.on_finished()
@@ -1,4 +1,6 @@
-import scipy.ndimage as nd
+import threading
+import traceback
+
 import wx
 from pubsub import pub as Publisher
 
@@ -6,16 +8,118 @@ import invesalius.data.slice_ as slc
 from invesalius import project
 
 from . import gui
+from . import resample
 
 
-def make_orthogonal(matrix, old_spacing, new_spacing):
-    zooms = [i / j for (i, j) in zip(old_spacing, new_spacing)]
-    new_image = nd.zoom(
-        matrix, zooms[::-1], output=matrix.dtype, mode="constant", cval=matrix.min()
+def make_orthogonal(
+    matrix,
+    old_spacing,
+    new_spacing,
+    memory_budget=resample.MEMORY_BUDGET,
+    workers=1,
+    interpolation=resample.SPLINE,
+    progress_callback=None,
+    cancel_event=None,
+    labels=None,
+):
+    zooms = resample.get_zooms(old_spacing, new_spacing)
+    result = resample.resample(
+        matrix,
+        zooms,
+        cval=matrix.min(),
+        memory_budget=memory_budget,
+        workers=workers,
+        interpolation=interpolation,
+        progress_callback=progress_callback,
+        cancel_event=cancel_event,
+        labels=labels,
     )
+    if result is None:
+        print("Change spacing cancelled")
+        return None
     print(f"Spacing: {old_spacing} -> {new_spacing}")
-    print(f"Shape: {matrix.shape} -> {new_image.shape}")
-    return new_image
+    print(f"Shape: {matrix.shape} -> {get_zoomed_shape(result)}")
+    return result
+
+
+def get_zoomed_shape(result):
+    if isinstance(result, tuple):
+        return result[0].shape
+    return result.shape
+
+
+def create_masks(masks, new_masks):
+    s = slc.Slice()
+    for mask, new_matrix in zip(masks, new_masks):
+        new_mask = s.create_new_mask(
+            name=mask.name,
+            colour=mask.colour,
+            threshold_range=mask.threshold_range,
+            add_to_project=True,
+            show=False,
+        )
+        new_mask.matrix[1:, 1:, 1:] = new_matrix
+        # Marking all slices as already thresholded.
+        new_mask.matrix[0] = 255
+        new_mask.matrix[:, 0, :] = 255
+        new_mask.matrix[:, :, 0] = 255
+        new_mask.was_edited = True
+        print(f"Mask {mask.name} resampled")
+    Publisher.sendMessage("Reload actual slice")
+
+
+class ResampleThread(threading.Thread):
+    def __init__(self, matrix, old_spacing, new_spacing, **kwargs):
+        super().__init__(daemon=True)
+        self.matrix = matrix
+        self.old_spacing = old_spacing
+        self.new_spacing = new_spacing
+        self.kwargs = kwargs
+        self.new_image = None
+        self.new_masks = []
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def run(self):
+        try:
+            result = make_orthogonal(
+                self.matrix,
+                self.old_spacing,
+                self.new_spacing,
+                progress_callback=self.on_progress,
+                cancel_event=self.cancel_event,
+                **self.kwargs,
+            )
+            if isinstance(result, tuple):
+                self.new_image, self.new_masks = result
+            else:
+                self.new_image = result
+        except Exception:
+            traceback.print_exc()
+            self.remove_outputs()
+        wx.CallAfter(Publisher.sendMessage, "Change spacing finished")
+
+    def remove_outputs(self):
+        """
+        Removes the files of the resampled image and masks, once they were
+        copied to the project.
+        """
+        filenames = [
+            getattr(i, "filename", None) for i in [self.new_image] + self.new_masks
+        ]
+        self.new_image = None
+        self.new_masks = []
+        resample.remove_outputs(filenames)
+
+    def on_progress(self, done, total):
+        wx.CallAfter(
+            Publisher.sendMessage, "Change spacing progress", done=done, total=total
+        )
 
 
 def load():
@@ -31,16 +135,44 @@ def load():
     g = gui.GUIIsotropic(wx.GetApp().GetTopWindow())
     g.set_original_spacing(*spacing)
     g.set_new_spacing(*new_spacing)
+    g.set_image(image_matrix)
     if g.ShowModal() == wx.ID_OK:
         new_spacing = (g.spacing_new_x, g.spacing_new_y, g.spacing_new_z)
-        new_image = make_orthogonal(image_matrix, spacing, new_spacing)
+        workers = g.spin_workers.GetValue()
+        interpolation = g.get_interpolation()
         new_instance = g.cb_new_inv_instance.GetValue()
 
-        Publisher.sendMessage(
-            "Create project from matrix",
-            name=new_name,
-            matrix=new_image,
-            spacing=new_spacing,
-            new_instance=new_instance
+        # Masks can only be carried to a project opened in this instance.
+        masks = []
+        if g.cb_resample_masks.GetValue() and not new_instance:
+            masks = [p.mask_dict[i] for i in sorted(p.mask_dict)]
+            for mask in masks:
+                s.do_threshold_to_all_slices(mask)
+
+        worker = ResampleThread(
+            image_matrix,
+            spacing,
+            new_spacing,
+            workers=workers,
+            interpolation=interpolation,
+            labels=[mask.matrix[1:, 1:, 1:] for mask in masks] if masks else None,
         )
+
+        def on_finished():
+            if worker.new_image is None:
+                return
+            Publisher.sendMessage(
+                "Create project from matrix",
+                name=new_name,
+                matrix=worker.new_image,
+                spacing=new_spacing,
+                new_instance=new_instance
+            )
+            if worker.new_masks:
+                create_masks(masks, worker.new_masks)
+            # The project and the masks have their own copies of the matrices.
+            worker.remove_outputs()
+
+        gui.ResampleProgressDialog(wx.GetApp().GetTopWindow(), worker, on_finished)
+        worker.start()
     g.Destroy()
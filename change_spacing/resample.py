@@ -0,0 +1,568 @@
+import concurrent.futures
+import math
+import os
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import scipy.ndimage as nd
+
+# Maximum amount of memory (in bytes) used by the slabs being resampled.
+MEMORY_BUDGET = 2 * 1024 ** 3
+MAX_SLAB_SLICES = 64
+WORKERS = os.cpu_count() or 1
+PREVIEW_SIZE = 256
+# Size of the block resampled to estimate the runtime.
+ESTIMATE_BLOCK = (16, 64, 64)
+# Extra input slices around each slab so the spline prefilter converges to the
+# same coefficients it would have when filtering the whole volume.
+SPLINE_MARGIN = 24
+
+SPLINE = "Spline"
+LINEAR = "Linear"
+CUBIC = "Cubic"
+LANCZOS = "Lanczos"
+NEAREST = "Nearest"
+INTERPOLATIONS = (SPLINE, LINEAR, CUBIC, LANCZOS)
+
+# affine_transform with a 1-D matrix is exactly the zoom + shift we want.
+warnings.filterwarnings(
+    "ignore", message="The behavior of affine_transform with a 1-D array"
+)
+
+
+def get_zooms(old_spacing, new_spacing):
+    # Spacings are (x, y, z), the matrix is (z, y, x).
+    zooms = [i / j for (i, j) in zip(old_spacing, new_spacing)]
+    return tuple(zooms[::-1])
+
+
+def get_output_shape(shape, zooms):
+    return tuple(int(round(s * z)) for (s, z) in zip(shape, zooms))
+
+
+def get_ratios(shape, output_shape):
+    # Same mapping used by nd.zoom: first and last samples are aligned.
+    return tuple(
+        (i - 1) / (o - 1) if o > 1 else 1.0 for (i, o) in zip(shape, output_shape)
+    )
+
+
+def _kernel_nearest(t):
+    return (np.abs(t) < 0.5).astype(np.float32)
+
+
+def _kernel_linear(t):
+    return np.maximum(1.0 - np.abs(t), 0.0)
+
+
+def _kernel_cubic(t, a=-0.5):
+    # Keys cubic convolution.
+    t = np.abs(t)
+    return np.where(
+        t <= 1.0,
+        ((a + 2.0) * t - (a + 3.0)) * t * t + 1.0,
+        np.where(t < 2.0, ((a * t - 5.0 * a) * t + 8.0 * a) * t - 4.0 * a, 0.0),
+    )
+
+
+def _kernel_lanczos(t, a=3):
+    return np.where(np.abs(t) < a, np.sinc(t) * np.sinc(t / a), 0.0)
+
+
+# interpolation: (kernel, support)
+KERNELS = {
+    NEAREST: (_kernel_nearest, 1),
+    LINEAR: (_kernel_linear, 1),
+    CUBIC: (_kernel_cubic, 2),
+    LANCZOS: (_kernel_lanczos, 3),
+}
+
+
+def get_margin(order, interpolation=SPLINE):
+    if interpolation != SPLINE:
+        return KERNELS[interpolation][1] + 1
+    if order <= 1:
+        return 1
+    return order // 2 + 1 + SPLINE_MARGIN
+
+
+def _get_slice_bytes(shape, itemsize, order, interpolation):
+    dz, dy, dx = shape
+    # The input slab is copied and, for spline orders, prefiltered into
+    # float64.
+    if order > 1 and interpolation == SPLINE:
+        return dy * dx * (itemsize + 8)
+    return dy * dx * itemsize
+
+
+def _get_output_slice_bytes(shape, output_shape, interpolation):
+    # The separable kernels keep, per output slice, up to four float32
+    # buffers (the data, the sum, a tap and its copy) as large as the bigger
+    # of the input and output slices.
+    if interpolation == SPLINE:
+        return 0
+    dy = max(shape[1], output_shape[1])
+    dx = max(shape[2], output_shape[2])
+    return 4 * 4 * dy * dx
+
+
+def get_slab_size(
+    shape,
+    output_shape,
+    itemsize,
+    order=3,
+    memory_budget=MEMORY_BUDGET,
+    interpolation=SPLINE,
+):
+    rz = get_ratios(shape, output_shape)[0]
+    margin = get_margin(order, interpolation)
+    slice_bytes = _get_slice_bytes(shape, itemsize, order, interpolation)
+    output_slice_bytes = _get_output_slice_bytes(shape, output_shape, interpolation)
+    # Solving get_slab_bytes(slab_size) <= memory_budget.
+    slab_size = int(
+        (memory_budget - (2 * margin + 2) * slice_bytes)
+        / (max(rz, 1e-6) * slice_bytes + output_slice_bytes)
+    )
+    return max(1, min(slab_size, MAX_SLAB_SLICES, output_shape[0]))
+
+
+def get_slab_bytes(
+    shape, output_shape, itemsize, slab_size, order=3, interpolation=SPLINE
+):
+    rz = get_ratios(shape, output_shape)[0]
+    margin = get_margin(order, interpolation)
+    input_slices = min(shape[0], math.ceil(slab_size * rz) + 2 * margin + 2)
+    return input_slices * _get_slice_bytes(
+        shape, itemsize, order, interpolation
+    ) + slab_size * _get_output_slice_bytes(shape, output_shape, interpolation)
+
+
+def iter_slabs(shape, output_shape, slab_size, order=3, interpolation=SPLINE):
+    rz = get_ratios(shape, output_shape)[0]
+    margin = get_margin(order, interpolation)
+    for oz0 in range(0, output_shape[0], slab_size):
+        oz1 = min(oz0 + slab_size, output_shape[0])
+        iz0 = max(int(math.floor(oz0 * rz)) - margin, 0)
+        iz1 = min(int(math.ceil((oz1 - 1) * rz)) + margin + 1, shape[0])
+        yield (oz0, oz1), (iz0, iz1)
+
+
+def create_output(shape, dtype):
+    fd, temp_file = tempfile.mkstemp()
+    os.close(fd)
+    return np.memmap(temp_file, mode="w+", dtype=dtype, shape=shape)
+
+
+def remove_outputs(filenames):
+    """
+    Removes the files of the outputs given by create_output, their memmaps
+    must be released before.
+    """
+    for filename in filenames:
+        if filename is not None and os.path.exists(filename):
+            os.remove(filename)
+
+
+def get_axis_weights(size, output_range, ratio, start=0, interpolation=LINEAR):
+    """
+    Returns, for each output sample in output_range, the indices of the input
+    samples used and their weights. start is the global index of the first of
+    the size input samples given, so a slab is resampled with the same
+    coordinates of the whole volume.
+    """
+    kernel, support = KERNELS[interpolation]
+    coords = np.arange(*output_range, dtype=np.float64) * ratio - start
+    if interpolation == NEAREST:
+        indices = np.floor(coords + 0.5).astype(np.intp)[:, np.newaxis]
+        weights = np.ones(indices.shape, dtype=np.float32)
+    else:
+        first = np.floor(coords).astype(np.intp) - support + 1
+        indices = first[:, np.newaxis] + np.arange(2 * support)
+        weights = kernel(coords[:, np.newaxis] - indices)
+        weights /= weights.sum(1)[:, np.newaxis]
+        weights = weights.astype(np.float32)
+    np.clip(indices, 0, size - 1, out=indices)
+    return indices, weights
+
+
+def resample_axis(data, axis, output_range, ratio, start=0, interpolation=LINEAR):
+    indices, weights = get_axis_weights(
+        data.shape[axis], output_range, ratio, start, interpolation
+    )
+    shape = [1] * data.ndim
+    shape[axis] = indices.shape[0]
+    output = None
+    for i in range(indices.shape[1]):
+        tap = np.take(data, indices[:, i], axis=axis).astype(np.float32)
+        tap *= weights[:, i].reshape(shape)
+        if output is None:
+            output = tap
+        else:
+            output += tap
+    return output
+
+
+def _cast(data, output):
+    # When no axis is resampled data is still the input, not a float buffer.
+    if np.issubdtype(output.dtype, np.integer) and not np.issubdtype(
+        data.dtype, np.integer
+    ):
+        info = np.iinfo(output.dtype)
+        np.rint(data, out=data)
+        np.clip(data, info.min, info.max, out=data)
+    output[:] = data
+
+
+def resample_slab_separable(
+    matrix, output, ratios, output_slab, input_slab, interpolation=LINEAR
+):
+    # Only the axes whose size changes are resampled, one at a time.
+    iz0, iz1 = input_slab
+    data = np.asarray(matrix[iz0:iz1])
+    if output.shape[0] != matrix.shape[0]:
+        data = resample_axis(data, 0, output_slab, ratios[0], iz0, interpolation)
+    else:
+        # Drops the margin slices of the input slab.
+        data = data[output_slab[0] - iz0 : output_slab[1] - iz0]
+    for axis in (1, 2):
+        if output.shape[axis] != matrix.shape[axis]:
+            data = resample_axis(
+                data, axis, (0, output.shape[axis]), ratios[axis], 0, interpolation
+            )
+    _cast(data, output[output_slab[0] : output_slab[1]])
+
+
+def get_slab_offset(ratio, oz0, oz1, iz0, iz1):
+    """
+    The Z offset of the slab input for affine_transform. Rounded, the last
+    output slice could be mapped just past the last slice of the slab (and
+    filled with cval in constant mode) while nd.zoom maps it inside, so
+    then the offset is lowered until it's inside.
+    """
+    offset = oz0 * ratio - iz0
+    if (oz1 - 1) * ratio > iz1 - 1:
+        return offset
+    # affine_transform samples (z + offset / ratio) * ratio.
+    for _ in range(64):
+        if (oz1 - oz0 - 1 + offset / ratio) * ratio <= iz1 - iz0 - 1:
+            break
+        offset = np.nextafter(offset, -np.inf)
+    return offset
+
+
+def resample_slab_spline(
+    matrix, output, ratios, output_slab, input_slab, order=3, cval=0
+):
+    oz0, oz1 = output_slab
+    iz0, iz1 = input_slab
+    # nd.zoom never samples outside the input grid, so for order <= 1 (no
+    # prefilter) nearest gives the same values while being robust to the
+    # rounding of the slab offset at the last slice.
+    mode = "nearest" if order <= 1 else "constant"
+    offset = get_slab_offset(ratios[0], oz0, oz1, iz0, iz1)
+    nd.affine_transform(
+        np.asarray(matrix[iz0:iz1]),
+        ratios,
+        offset=(offset, 0.0, 0.0),
+        output=output[oz0:oz1],
+        order=order,
+        mode=mode,
+        cval=cval,
+    )
+
+
+def resample_slab(
+    matrix,
+    output,
+    ratios,
+    output_slab,
+    input_slab,
+    order=3,
+    cval=0,
+    interpolation=SPLINE,
+    labels=(),
+):
+    if interpolation == SPLINE:
+        resample_slab_spline(
+            matrix, output, ratios, output_slab, input_slab, order, cval
+        )
+    else:
+        resample_slab_separable(
+            matrix, output, ratios, output_slab, input_slab, interpolation
+        )
+
+    # Label volumes (masks) use nearest neighbour so no new values appear.
+    for label_matrix, label_output in labels:
+        if interpolation == SPLINE:
+            resample_slab_spline(
+                label_matrix, label_output, ratios, output_slab, input_slab, 0
+            )
+        else:
+            resample_slab_separable(
+                label_matrix, label_output, ratios, output_slab, input_slab, NEAREST
+            )
+
+
+def _resample_slab_process(matrix_info, output_info, *args):
+    # Runs in a worker process: the input and output are shared through their
+    # memmap files.
+    filename, dtype, shape, offset = matrix_info
+    matrix = np.memmap(filename, mode="r", dtype=dtype, shape=shape, offset=offset)
+    filename, dtype, shape, offset = output_info
+    output = np.memmap(filename, mode="r+", dtype=dtype, shape=shape, offset=offset)
+    resample_slab(matrix, output, *args)
+    output.flush()
+
+
+def get_workers(
+    shape,
+    output_shape,
+    itemsize,
+    order=3,
+    workers=WORKERS,
+    memory_budget=MEMORY_BUDGET,
+    interpolation=SPLINE,
+):
+    # The slab layout doesn't depend on the number of workers, so the parallel
+    # result is bit-identical to the serial one. Only the number of slabs in
+    # flight is limited by the memory budget.
+    slab_size = get_slab_size(
+        shape, output_shape, itemsize, order, memory_budget, interpolation
+    )
+    slab_bytes = get_slab_bytes(
+        shape, output_shape, itemsize, slab_size, order, interpolation
+    )
+    number_slabs = math.ceil(output_shape[0] / slab_size)
+    return max(1, min(workers, memory_budget // slab_bytes, number_slabs))
+
+
+def resample(
+    matrix,
+    zooms,
+    order=3,
+    cval=None,
+    output=None,
+    memory_budget=MEMORY_BUDGET,
+    workers=1,
+    use_processes=False,
+    interpolation=SPLINE,
+    progress_callback=None,
+    cancel_event=None,
+    labels=None,
+):
+    """
+    Resamples matrix by zooms slab by slab along Z. With the default SPLINE
+    interpolation the result is the same given by nd.zoom(matrix, zooms,
+    mode="constant"); LINEAR, CUBIC and LANCZOS resample only the axes whose
+    size changes, one at a time. Only a slab of the input is held in memory at
+    a time and it's written into output (a np.memmap if not given). With
+    workers > 1 the slabs are resampled in a thread pool (or a process pool if
+    use_processes and both matrix and output are memmaps).
+
+    labels is a list of volumes with the same shape of matrix (masks) that are
+    resampled with nearest neighbour in the same pass. When given, the
+    resampled labels are returned too: (output, labels_output).
+
+    progress_callback(done, total) is called after each slab. If cancel_event
+    (a threading.Event) is set the remaining slabs are skipped and None is
+    returned.
+    """
+    output_shape = get_output_shape(matrix.shape, zooms)
+    created_output = output is None
+    if created_output:
+        output = create_output(output_shape, matrix.dtype)
+    if cval is None:
+        cval = matrix.min()
+
+    labels_output = []
+    for label_matrix in labels or ():
+        labels_output.append(create_output(output_shape, label_matrix.dtype))
+    labels_pairs = list(zip(labels or (), labels_output))
+
+    ratios = get_ratios(matrix.shape, output_shape)
+    itemsize = matrix.dtype.itemsize
+    for label_matrix in labels or ():
+        itemsize += label_matrix.dtype.itemsize
+    slab_size = get_slab_size(
+        matrix.shape, output_shape, itemsize, order, memory_budget, interpolation
+    )
+    slabs = [
+        (ratios, output_slab, input_slab, order, cval, interpolation, labels_pairs)
+        for output_slab, input_slab in iter_slabs(
+            matrix.shape, output_shape, slab_size, order, interpolation
+        )
+    ]
+    workers = get_workers(
+        matrix.shape,
+        output_shape,
+        itemsize,
+        order,
+        workers,
+        memory_budget,
+        interpolation,
+    )
+
+    def is_cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    def run_slab(args):
+        if not is_cancelled():
+            resample_slab(matrix, output, *args)
+
+    def get_filenames():
+        filenames = [i.filename for i in labels_output]
+        if created_output:
+            filenames.append(output.filename)
+        return filenames
+
+    try:
+        if workers == 1:
+            for done, args in enumerate(slabs, 1):
+                run_slab(args)
+                if progress_callback is not None:
+                    progress_callback(done, len(slabs))
+        else:
+            if (
+                use_processes
+                and not labels_pairs
+                and isinstance(matrix, np.memmap)
+                and isinstance(output, np.memmap)
+            ):
+                output.flush()
+                matrix_info = (
+                    matrix.filename,
+                    matrix.dtype,
+                    matrix.shape,
+                    matrix.offset,
+                )
+                output_info = (
+                    output.filename,
+                    output.dtype,
+                    output.shape,
+                    output.offset,
+                )
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+                futures = [
+                    executor.submit(
+                        _resample_slab_process, matrix_info, output_info, *args
+                    )
+                    for args in slabs
+                ]
+            else:
+                # nd.affine_transform and numpy release the GIL, threads are enough.
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+                futures = [executor.submit(run_slab, args) for args in slabs]
+
+            with executor:
+                for done, future in enumerate(
+                    concurrent.futures.as_completed(futures), 1
+                ):
+                    future.result()
+                    if is_cancelled():
+                        for pending in futures:
+                            pending.cancel()
+                        break
+                    if progress_callback is not None:
+                        progress_callback(done, len(slabs))
+    except BaseException:
+        filenames = get_filenames()
+        output = labels_output = labels_pairs = slabs = None
+        remove_outputs(filenames)
+        raise
+
+    if is_cancelled():
+        filenames = get_filenames()
+        # Releasing the memmaps before removing their files.
+        output = labels_output = labels_pairs = slabs = None
+        remove_outputs(filenames)
+        return None
+
+    if isinstance(output, np.memmap):
+        output.flush()
+    for label_output in labels_output:
+        label_output.flush()
+
+    if labels is not None:
+        return output, labels_output
+    return output
+
+
+def get_preview(
+    matrix, zooms, orientation="AXIAL", interpolation=LINEAR, max_size=PREVIEW_SIZE
+):
+    """
+    Returns the middle axial or coronal slice of the resampled image at most
+    max_size x max_size. Only the input slices around that plane are read.
+    """
+    output_shape = get_output_shape(matrix.shape, zooms)
+    ratios = get_ratios(matrix.shape, output_shape)
+    axis = {"AXIAL": 0, "CORONAL": 1}[orientation]
+    if interpolation == SPLINE:
+        interpolation = CUBIC
+
+    n = output_shape[axis] // 2
+    indices, weights = get_axis_weights(
+        matrix.shape[axis], (n, n + 1), ratios[axis], 0, interpolation
+    )
+    plane = None
+    for i, w in zip(indices[0], weights[0]):
+        tap = np.take(matrix, i, axis=axis).astype(np.float32) * w
+        if plane is None:
+            plane = tap
+        else:
+            plane += tap
+
+    plane_shape = [s for i, s in enumerate(output_shape) if i != axis]
+    scale = min(1.0, max_size / max(plane_shape))
+    for i, size in enumerate(plane_shape):
+        preview_size = max(1, int(round(size * scale)))
+        ratio = (plane.shape[i] - 1) / max(preview_size - 1, 1)
+        plane = resample_axis(plane, i, (0, preview_size), ratio, 0, LINEAR)
+    return plane
+
+
+def estimate(
+    matrix,
+    zooms,
+    order=3,
+    interpolation=SPLINE,
+    workers=1,
+    memory_budget=MEMORY_BUDGET,
+):
+    """
+    Returns the output shape, its size in bytes and the estimated runtime in
+    seconds, measured by resampling a small block of matrix.
+    """
+    output_shape = get_output_shape(matrix.shape, zooms)
+    nbytes = int(np.prod(output_shape, dtype=np.int64)) * matrix.dtype.itemsize
+
+    block = np.asarray(
+        matrix[tuple(slice(0, b) for b in ESTIMATE_BLOCK)], dtype=matrix.dtype
+    )
+    block_output_shape = get_output_shape(block.shape, zooms)
+    block_output = np.empty(block_output_shape, dtype=block.dtype)
+    t0 = time.perf_counter()
+    resample(
+        block,
+        zooms,
+        order=order,
+        output=block_output,
+        interpolation=interpolation,
+    )
+    elapsed = time.perf_counter() - t0
+
+    workers = get_workers(
+        matrix.shape,
+        output_shape,
+        matrix.dtype.itemsize,
+        order,
+        workers,
+        memory_budget,
+        interpolation,
+    )
+    voxels = np.prod(output_shape, dtype=np.float64)
+    block_voxels = max(np.prod(block_output_shape, dtype=np.float64), 1)
+    runtime = elapsed * voxels / block_voxels / workers
+    return output_shape, nbytes, runtime
@@ -0,0 +1,54 @@
+"""
+Compares the tiled simple_lbp against the old per-voxel kernel. Build the
+extension first and run it from this folder:
+
+    python setup.py build_ext --inplace
+    python benchmark.py --shape 256 256 256
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from simple_lbp import simple_lbp, simple_lbp_naive
+
+
+def create_image(shape, dtype):
+    z, y, x = np.ogrid[: shape[0], : shape[1], : shape[2]]
+    image = 100 * np.sin(x / 7.0) * np.cos(y / 11.0) + 50 * np.sin(z / 5.0)
+    image += np.random.normal(0, 10, shape)
+    return image.astype(dtype)
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - t0, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shape", type=int, nargs=3, default=(256, 256, 256))
+    parser.add_argument("--dtype", default="int16", choices=("int16", "uint8"))
+    args = parser.parse_args()
+
+    image = create_image(args.shape, args.dtype)
+    print(f"Shape: {image.shape}, dtype: {image.dtype}")
+
+    t, reference = timeit(simple_lbp_naive, image)
+    print(f"naive: {t:.2f}s")
+
+    t, out = timeit(simple_lbp, image)
+    print(f"tiled: {t:.2f}s, equal: {np.array_equal(out, reference)}")
+    del out
+
+    with tempfile.NamedTemporaryFile() as f:
+        out = np.memmap(f.name, dtype=np.uint8, mode="w+", shape=reference.shape)
+        t, out = timeit(simple_lbp, image, out)
+        print(f"tiled (memmap): {t:.2f}s, equal: {np.array_equal(out, reference)}")
+        del out
+
+
+if __name__ == "__main__":
+    main()
@@ -8,12 +8,15 @@ import invesalius.constants as const
 import invesalius.data.cursor_actors as ca
 import invesalius.utils as utils
 from invesalius.data import styles
-from sklearn.tree import DecisionTreeClassifier
 from sklearn.ensemble import RandomForestClassifier
 
-import imageio
-
+from . import feature_bank
+from . import feature_cache
+from . import incremental
+from . import markers
 from . import simple_lbp
+from . import slice_buffers
+from . import worker
 
 BRUSH_FOREGROUND = 1
 BRUSH_BACKGROUND = 2
@@ -39,6 +42,10 @@ class ClassificationConfig(with_metaclass(utils.Singleton, object)):
         self.operation = BRUSH_FOREGROUND
         self.cursor_type = const.BRUSH_CIRCLE
         self.cursor_size = const.BRUSH_SIZE
+        self.roi_margin = None
+        self.incremental = True
+        self.features = ("lbp",)
+        self.feature_sigmas = feature_bank.SIGMAS
 
         Publisher.subscribe(self.set_operation, "Set watershed operation")
         Publisher.subscribe(self.set_use_ww_wl, "Set use ww wl")
@@ -47,6 +54,9 @@ class ClassificationConfig(with_metaclass(utils.Singleton, object)):
         Publisher.subscribe(self.set_2dcon, "Set watershed 2d con")
         Publisher.subscribe(self.set_3dcon, "Set watershed 3d con")
         Publisher.subscribe(self.set_gaussian_size, "Set watershed gaussian size")
+        Publisher.subscribe(self.set_roi_margin, "Set classification roi margin")
+        Publisher.subscribe(self.set_incremental, "Set classification incremental")
+        Publisher.subscribe(self.set_features, "Set classification features")
 
     def set_operation(self, operation):
         self.operation = WATERSHED_OPERATIONS[operation]
@@ -66,17 +76,58 @@ class ClassificationConfig(with_metaclass(utils.Singleton, object)):
     def set_gaussian_size(self, size):
         self.mg_size = size
 
+    def set_roi_margin(self, margin):
+        self.roi_margin = margin
+
+    def set_incremental(self, incremental):
+        self.incremental = incremental
+
+    def set_features(self, features, sigmas=None):
+        self.features = tuple(features)
+        if sigmas is not None:
+            self.feature_sigmas = tuple(sigmas)
+
 
 class Classifier(with_metaclass(utils.Singleton, object)):
     def __init__(self):
         self.clf = RandomForestClassifier()
         self.image = None
         self.lbp_image = None
+        self.model = None
+        self.worker = None
+        self.feature_bank = None
+        # The markers index, shared by the viewers since they all paint the
+        # same markers matrix.
+        self.markers = None
         self.gx = None
         self.gy = None
         self.gz = None
         self.gm = None
 
+    def get_markers(self, matrix, labels):
+        if self.markers is None or self.markers.matrix is not matrix:
+            self.markers = markers.MarkerIndex(matrix, labels)
+        return self.markers
+
+    def get_feature_bank(self, selection, sigmas):
+        # Only the LBP codes, the (incremental) LBP classifier is used.
+        if tuple(selection) == ("lbp",):
+            return None
+        bank = self.feature_bank
+        if bank is None or bank.selection != selection or bank.sigmas != sigmas:
+            self.feature_bank = feature_bank.FeatureBank(
+                self.image, self.lbp_image, selection, sigmas
+            )
+        return self.feature_bank
+
+    def get_worker(self):
+        if self.worker is None:
+            self.worker = worker.ClassificationThread(
+                self.model, BRUSH_FOREGROUND, BRUSH_BACKGROUND
+            )
+            self.worker.start()
+        return self.worker
+
 
 class ClassificationStyle(styles.BaseImageEditionInteractorStyle):
     def __init__(self, viewer):
@@ -85,25 +136,49 @@ class ClassificationStyle(styles.BaseImageEditionInteractorStyle):
         self.viewer = viewer
         self.orientation = self.viewer.orientation
         self.matrix = None
+        self.markers = None
         self.fill_value = BRUSH_FOREGROUND
         self.config = ClassificationConfig()
         self.classifier = Classifier()
 
         if self.classifier.image is None:
-            image = styles.get_LUT_value_255(self.viewer.slice_.matrix, self.viewer.slice_.window_width, self.viewer.slice_.window_level)
+            slice_ = self.viewer.slice_
+            key = feature_cache.get_key(
+                slice_.matrix, "lbp", slice_.window_width, slice_.window_level
+            )
+
+            def compute_lbp(out):
+                image = styles.get_LUT_value_255(
+                    slice_.matrix, slice_.window_width, slice_.window_level
+                )
+                simple_lbp.simple_lbp(image, out)
+
             #  gz, gy, gx = np.gradient(image)
             #  gm = np.sqrt(gx**2 + gy**2 + gz**2)
             #  self.classifier.gx = np.nan_to_num(gx / gm)
             #  self.classifier.gy = np.nan_to_num(gy / gm)
             #  self.classifier.gz = np.nan_to_num(gz / gm)
             #  self.classifier.gm = gm
-            self.classifier.image = image
-            self.classifier.lbp_image = simple_lbp.simple_lbp(image)
-
-            imageio.imsave('/tmp/saida.png', self.classifier.lbp_image[image.shape[0]//2])
+            self.classifier.image = slice_.matrix
+            self.classifier.lbp_image = feature_cache.get_features(
+                key, slice_.matrix.shape + (3,), np.uint8, compute_lbp
+            )
 
     def SetUp(self):
         self._create_mask()
+        self.markers = self.classifier.get_markers(
+            self.matrix, (BRUSH_FOREGROUND, BRUSH_BACKGROUND)
+        )
+        if self.classifier.model is None:
+            self.classifier.model = incremental.IncrementalClassifier(
+                self.classifier.lbp_image, BRUSH_FOREGROUND, BRUSH_BACKGROUND
+            )
+            for label, index in self.markers.voxels.items():
+                self.classifier.model.update_markers(
+                    index,
+                    np.zeros(index.shape, dtype=self.matrix.dtype),
+                    np.full(index.shape, label, dtype=self.matrix.dtype),
+                )
         self.viewer.slice_.to_show_aux = "classify"
         self.viewer.slice_.aux_matrices_colours[self.viewer.slice_.to_show_aux] = {
             BRUSH_ERASE: (0.0, 0.0, 0.0, 0.0),
@@ -170,45 +245,37 @@ class ClassificationStyle(styles.BaseImageEditionInteractorStyle):
         else:
             self.fill_value = BRUSH_FOREGROUND
 
+    def edit_mask_pixel(self, fill_value, n, index, position, radius, orientation):
+        self.markers.mark_dirty(orientation, n)
+        super().edit_mask_pixel(fill_value, n, index, position, radius, orientation)
+
     def after_brush_release(self):
-        if BRUSH_FOREGROUND in self.matrix and BRUSH_BACKGROUND in self.matrix:
-            image = self.classifier.image
-            lbp_image = self.classifier.lbp_image
-            values_marker1 = image[self.matrix == BRUSH_FOREGROUND]
-            values_marker2 = image[self.matrix == BRUSH_BACKGROUND]
-            clf_values = np.empty(values_marker1.shape[0] + values_marker2.shape[0])
-            clf_values[:values_marker1.shape[0]] = BRUSH_FOREGROUND
-            clf_values[values_marker1.shape[0]:] = BRUSH_BACKGROUND
-
-            values_markers = np.empty((values_marker1.shape[0] + values_marker2.shape[0], 3))
-
-            #  values_markers[:values_marker1.shape[0], 0] = values_marker1
-            values_markers[:values_marker1.shape[0]] = lbp_image[self.matrix == BRUSH_FOREGROUND]
-            #  values_markers[:values_marker1.shape[0], 1] = self.classifier.gx[self.matrix == BRUSH_FOREGROUND]
-            #  values_markers[:values_marker1.shape[0], 2] = self.classifier.gy[self.matrix == BRUSH_FOREGROUND]
-            #  values_markers[:values_marker1.shape[0], 3] = self.classifier.gz[self.matrix == BRUSH_FOREGROUND]
-            #  values_markers[:values_marker1.shape[0], 4] = self.classifier.gm[self.matrix == BRUSH_FOREGROUND]
-
-            #  values_markers[values_marker1.shape[0]:, 0] = values_marker2
-            values_markers[values_marker1.shape[0]:] = lbp_image[self.matrix == BRUSH_BACKGROUND]
-            #  values_markers[values_marker1.shape[0]:, 1] = self.classifier.gx[self.matrix == BRUSH_BACKGROUND]
-            #  values_markers[values_marker1.shape[0]:, 2] = self.classifier.gy[self.matrix == BRUSH_BACKGROUND]
-            #  values_markers[values_marker1.shape[0]:, 3] = self.classifier.gz[self.matrix == BRUSH_BACKGROUND]
-            #  values_markers[values_marker1.shape[0]:, 4] = self.classifier.gm[self.matrix == BRUSH_BACKGROUND]
-
-            clf = DecisionTreeClassifier(max_depth=100)
-            clf.fit(values_markers, clf_values)
-
-            input_array = np.empty((image.size, 3))
-            #  input_array[:, 0] = image.flatten()
-            input_array[:] = lbp_image.reshape((-1, 3))
-            #  input_array[:, 2] = self.classifier.gy.flatten()
-            #  input_array[:, 3] = self.classifier.gz.flatten()
-            #  input_array[:, 4] = self.classifier.gm.flatten()
-
-            Z = clf.predict(input_array)
-            Z.shape = image.shape
-
-            mask = self.viewer.slice_.current_mask.matrix[1:, 1:, 1:]
-            mask[Z == BRUSH_FOREGROUND] = 254
-            mask[Z == BRUSH_BACKGROUND] = 1
+        # The changes are taken here, the user can keep editing the markers
+        # while the classification runs in the worker thread.
+        changes = self.markers.get_changes()
+        job = worker.ClassificationJob(
+            changes,
+            dict(self.markers.voxels),
+            self.viewer.slice_.current_mask,
+            self.config.incremental,
+            self.config.roi_margin,
+            self.get_visible_planes(),
+            self.reload_mask,
+            self.classifier.get_feature_bank(
+                self.config.features, self.config.feature_sigmas
+            ),
+        )
+        self.classifier.get_worker().submit(job)
+
+    def get_visible_planes(self):
+        planes = []
+        for axis, orientation in enumerate(("AXIAL", "CORONAL", "SAGITAL")):
+            n = self.viewer.slice_.buffer_slices[orientation].index
+            if 0 <= n < self.matrix.shape[axis]:
+                planes.append((orientation, n))
+        return planes
+
+    def reload_mask(self, bbox=None):
+        self.viewer.slice_.current_mask.was_edited = True
+        if slice_buffers.discard_buffers(self.viewer.slice_, bbox):
+            Publisher.sendMessage("Reload actual slice")
@@ -0,0 +1,218 @@
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, gaussian_gradient_magnitude
+
+FEATURES = ("gaussian", "gradient", "hessian", "lbp")
+SIGMAS = (1.0, 2.0, 4.0)
+BLOCK_SHAPE = (32, 64, 64)
+# Chunks used to predict, in tiles so the halo is not computed again for
+# each thin slab.
+TILE_SHAPE = (32, 128, 128)
+WORKERS = os.cpu_count() or 1
+
+
+def get_eigenvalues(hzz, hzy, hzx, hyy, hyx, hxx):
+    """
+    Eigenvalues (descending) of the symmetric 3x3 matrices given by their 6
+    components, using the closed form (trigonometric) solution.
+    """
+    q = (hzz + hyy + hxx) / 3.0
+    p1 = hzy**2 + hzx**2 + hyx**2
+    p2 = (hzz - q) ** 2 + (hyy - q) ** 2 + (hxx - q) ** 2 + 2.0 * p1
+    p = np.sqrt(p2 / 6.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv_p = np.where(p > 0, 1.0 / p, 0).astype(np.float32)
+    bzz = (hzz - q) * inv_p
+    byy = (hyy - q) * inv_p
+    bxx = (hxx - q) * inv_p
+    bzy = hzy * inv_p
+    bzx = hzx * inv_p
+    byx = hyx * inv_p
+    det = (
+        bzz * (byy * bxx - byx * byx)
+        - bzy * (bzy * bxx - byx * bzx)
+        + bzx * (bzy * byx - byy * bzx)
+    )
+    phi = np.arccos(np.clip(det / 2.0, -1.0, 1.0)) / 3.0
+    e1 = q + 2.0 * p * np.cos(phi)
+    e3 = q + 2.0 * p * np.cos(phi + (2.0 * np.pi / 3.0))
+    e2 = 3.0 * q - e1 - e3
+    return e1, e2, e3
+
+
+class FeatureBank:
+    """
+    Voxel features computed on demand in float32: gaussian smoothing,
+    gradient magnitude and hessian eigenvalues at each of sigmas, plus the 3
+    LBP codes. Indexing it (features[z0:z1, y0:y1, x0:x1]) returns the
+    (dz, dy, dx, nfeatures) array, computed in blocks (with a halo so the
+    result is the same as filtering the whole volume) by a thread pool.
+    """
+
+    def __init__(
+        self,
+        image,
+        lbp_image=None,
+        selection=FEATURES,
+        sigmas=SIGMAS,
+        block_shape=BLOCK_SHAPE,
+        workers=WORKERS,
+    ):
+        self.image = image
+        self.lbp_image = lbp_image
+        self.selection = tuple(selection)
+        self.sigmas = tuple(sigmas)
+        self.block_shape = tuple(block_shape)
+        self.workers = workers
+        self.shape = image.shape
+        self.halo = int(4.0 * max(self.sigmas) + 0.5)
+
+        self.names = []
+        for name in self.selection:
+            if name == "gaussian":
+                self.names.extend(f"gaussian_{s}" for s in self.sigmas)
+            elif name == "gradient":
+                self.names.extend(f"gradient_{s}" for s in self.sigmas)
+            elif name == "hessian":
+                for s in self.sigmas:
+                    self.names.extend(f"hessian_{s}_{i}" for i in range(3))
+            elif name == "lbp":
+                if lbp_image is None:
+                    raise ValueError("lbp feature needs lbp_image")
+                self.names.extend(("lbp_axial", "lbp_coronal", "lbp_sagital"))
+            else:
+                raise ValueError(f"Unknown feature {name}")
+
+    @property
+    def nfeatures(self):
+        return len(self.names)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        bbox = []
+        squeeze = []
+        for axis, (k, size) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step != 1:
+                    raise IndexError("Only slices with step 1 are supported")
+                bbox.append(slice(start, max(start, stop)))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += size
+                bbox.append(slice(k, k + 1))
+                squeeze.append(axis)
+        out = self.compute(tuple(bbox))
+        if squeeze:
+            out = out.squeeze(axis=tuple(squeeze))
+        return out
+
+    def compute(self, bbox, out=None):
+        shape = tuple(s.stop - s.start for s in bbox)
+        if out is None:
+            out = np.empty(shape + (self.nfeatures,), dtype=np.float32)
+        ranges = [
+            range(s.start, s.stop, b) for s, b in zip(bbox, self.block_shape)
+        ]
+        blocks = []
+        for starts in itertools.product(*ranges):
+            block = tuple(
+                slice(i, min(i + b, s.stop))
+                for i, b, s in zip(starts, self.block_shape, bbox)
+            )
+            dst = tuple(
+                slice(b.start - s.start, b.stop - s.start) for b, s in zip(block, bbox)
+            )
+            blocks.append((block, out[dst]))
+        if len(blocks) == 1 or self.workers == 1:
+            for block, dst in blocks:
+                self._compute_block(block, dst)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for future in [
+                    executor.submit(self._compute_block, block, dst)
+                    for block, dst in blocks
+                ]:
+                    future.result()
+        return out
+
+    def _compute_block(self, block, out):
+        outer = []
+        inner = []
+        for s, size in zip(block, self.shape):
+            start = max(0, s.start - self.halo)
+            stop = min(size, s.stop + self.halo)
+            outer.append(slice(start, stop))
+            inner.append(slice(s.start - start, s.stop - start))
+        inner = tuple(inner)
+        image = np.asarray(self.image[tuple(outer)], dtype=np.float32)
+
+        k = 0
+        for name in self.selection:
+            if name == "gaussian":
+                for s in self.sigmas:
+                    out[..., k] = gaussian_filter(image, s, output=np.float32)[inner]
+                    k += 1
+            elif name == "gradient":
+                for s in self.sigmas:
+                    out[..., k] = gaussian_gradient_magnitude(
+                        image, s, output=np.float32
+                    )[inner]
+                    k += 1
+            elif name == "hessian":
+                for s in self.sigmas:
+                    h = []
+                    for i, j in ((0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)):
+                        order = [0, 0, 0]
+                        order[i] += 1
+                        order[j] += 1
+                        h.append(
+                            gaussian_filter(image, s, order=order, output=np.float32)[
+                                inner
+                            ]
+                        )
+                    for e in get_eigenvalues(*h):
+                        out[..., k] = e
+                        k += 1
+            elif name == "lbp":
+                out[..., k : k + 3] = self.lbp_image[block]
+                k += 3
+
+    def get_values(self, index):
+        """
+        Returns the (len(index), nfeatures) features of the voxels with the
+        given flat indices, computing only around them.
+        """
+        index = np.asarray(index)
+        values = np.empty((index.size, self.nfeatures), dtype=np.float32)
+        if index.size == 0:
+            return values
+        coords = np.array(np.unravel_index(index, self.shape))
+        blocks = coords // np.array(self.block_shape)[:, np.newaxis]
+        block_ids = np.ravel_multi_index(
+            blocks, [(i + b - 1) // b for i, b in zip(self.shape, self.block_shape)]
+        )
+        order = np.argsort(block_ids, kind="stable")
+        ids, starts = np.unique(block_ids[order], return_index=True)
+
+        def get_group_values(group):
+            c = coords[:, group]
+            start = c.min(1)
+            stop = c.max(1) + 1
+            bbox = tuple(slice(int(a), int(b)) for a, b in zip(start, stop))
+            features = np.empty(
+                tuple(stop - start) + (self.nfeatures,), dtype=np.float32
+            )
+            self._compute_block(bbox, features)
+            values[group] = features[tuple(c - start[:, np.newaxis])]
+
+        groups = np.split(order, starts[1:])
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(get_group_values, groups))
+        return values
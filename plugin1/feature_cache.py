@@ -0,0 +1,118 @@
+import hashlib
+import os
+import pathlib
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from invesalius import inv_paths
+
+CACHE_DIR = pathlib.Path(inv_paths.USER_INV_DIR).joinpath("feature_cache")
+MAX_CACHE_SIZE = 8 * 1024**3
+HASH_CHUNK_SIZE = 64 * 1024**2
+
+
+def get_key(matrix, *params):
+    """
+    Hash of the matrix data and the parameters used to compute the features,
+    used as the file name of the cached features.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((matrix.shape, matrix.dtype.str, params)).encode("utf8"))
+    # Hashing by slices to avoid a copy of the whole (memmapped) matrix.
+    slices_per_chunk = max(1, HASH_CHUNK_SIZE // max(1, matrix[0].nbytes))
+    for z in range(0, matrix.shape[0], slices_per_chunk):
+        h.update(np.ascontiguousarray(matrix[z : z + slices_per_chunk]).data)
+    return h.hexdigest()
+
+
+def get_path(key, name="features"):
+    return CACHE_DIR.joinpath(f"{key}_{name}.npy")
+
+
+def touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def get_features(key, shape, dtype, compute):
+    """
+    Returns the features identified by key as a read-only memmap. If they
+    aren't cached compute(out) is called to fill a new memmapped .npy file.
+    """
+    path = get_path(key)
+    if path.exists():
+        try:
+            features = np.load(path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            print("Error loading cached features", path, e)
+        else:
+            if features.shape == tuple(shape):
+                touch(path)
+                return features
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    evict(MAX_CACHE_SIZE - np.dtype(dtype).itemsize * int(np.prod(shape)))
+    tmp_path = path.with_suffix(".tmp")
+    out = open_memmap(str(tmp_path), mode="w+", dtype=dtype, shape=tuple(shape))
+    compute(out)
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+def open_features(key, shape, dtype, nblocks):
+    """
+    Returns the (features, computed) memmaps of features computed block by
+    block. computed has one flag per block, set after the block is written in
+    features, so they are kept between sessions.
+    """
+    path = get_path(key, "lazy")
+    blocks_path = get_path(key, "blocks")
+    try:
+        features = np.load(path, mmap_mode="r+")
+        computed = np.load(blocks_path, mmap_mode="r+")
+        if features.shape == tuple(shape) and computed.shape == tuple(nblocks):
+            touch(path)
+            touch(blocks_path)
+            return features, computed
+    except (OSError, ValueError):
+        pass
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    evict(MAX_CACHE_SIZE - np.dtype(dtype).itemsize * int(np.prod(shape)))
+    # The flags are created first, so a features file without them is never
+    # used.
+    computed = open_memmap(
+        str(blocks_path), mode="w+", dtype=np.uint8, shape=tuple(nblocks)
+    )
+    features = open_memmap(str(path), mode="w+", dtype=dtype, shape=tuple(shape))
+    return features, computed
+
+
+def evict(max_size=MAX_CACHE_SIZE):
+    """
+    Removes the least recently used features until the cache is smaller than
+    max_size bytes.
+    """
+    if not CACHE_DIR.exists():
+        return
+    files = []
+    for f in CACHE_DIR.glob("*"):
+        try:
+            stat = f.stat()
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, f))
+    files.sort()
+    size = sum(i[1] for i in files)
+    for _, fsize, f in files:
+        if size <= max_size:
+            break
+        try:
+            f.unlink()
+        except OSError:
+            # Probably in use (Windows)
+            continue
+        size -= fsize
@@ -0,0 +1,232 @@
+import numpy as np
+from sklearn.tree import DecisionTreeClassifier
+
+from . import inference
+from .markers import get_plane
+
+NCODES = 2**24
+SLAB_SIZE = 16
+
+
+def pack_codes(lbp):
+    """
+    Packs the 3 LBP codes (axial, coronal, sagital) of each voxel in one
+    24 bits code.
+    """
+    lbp = np.asarray(lbp)
+    codes = lbp[..., 0].astype(np.uint32)
+    codes |= lbp[..., 1].astype(np.uint32) << 8
+    codes |= lbp[..., 2].astype(np.uint32) << 16
+    return codes
+
+
+def unpack_codes(codes):
+    lbp = np.empty(codes.shape + (3,), dtype=np.uint8)
+    lbp[..., 0] = codes & 0xFF
+    lbp[..., 1] = (codes >> 8) & 0xFF
+    lbp[..., 2] = (codes >> 16) & 0xFF
+    return lbp
+
+
+class IncrementalClassifier:
+    """
+    Classifier trained with the markers added and removed since the last fit.
+
+    The features are the packed LBP codes, so the training set is kept as
+    the number of foreground and background markers of each code and the
+    tree is fitted with the distinct codes weighted by those counts. The
+    prediction is done only once per code present in the volume (a LUT) and
+    only the slabs with codes whose class changed are written again.
+    """
+
+    def __init__(self, lbp_image, foreground, background, slab_size=SLAB_SIZE):
+        self.lbp_image = lbp_image
+        self.foreground = foreground
+        self.background = background
+        self.slab_size = slab_size
+        self.codes = np.zeros(0, dtype=np.uint32)
+        self.counts = np.zeros((0, 2), dtype=np.int64)
+        # 0 means not written to the mask yet.
+        self.lut = np.zeros(NCODES, dtype=np.uint8)
+        self.present = None
+        self.slabs_present = None
+        # Slabs and planes written with a LUT different from self.lut
+        # (cancelled predict).
+        self.dirty_slabs = set()
+        self.dirty_planes = set()
+        # Bounding box of the voxels written by the last predict.
+        self.written = None
+
+    def update(self, codes, labels, delta):
+        fg = labels == self.foreground
+        bg = labels == self.background
+        sel = fg | bg
+        if not sel.any():
+            return
+        counts = np.zeros((codes.size, 2), dtype=np.int64)
+        counts[fg, 0] = delta
+        counts[bg, 1] = delta
+        codes, inv = np.unique(
+            np.concatenate((self.codes, codes[sel])), return_inverse=True
+        )
+        new_counts = np.zeros((codes.size, 2), dtype=np.int64)
+        np.add.at(new_counts, inv, np.concatenate((self.counts, counts[sel])))
+        keep = new_counts.any(1)
+        self.codes = codes[keep]
+        self.counts = new_counts[keep]
+
+    def update_markers(self, index, old, new):
+        """
+        index are the flat indices of the markers changed from old to new.
+        """
+        if index.size == 0:
+            return
+        codes = pack_codes(self.lbp_image.reshape(-1, 3)[index])
+        self.update(codes, old, -1)
+        self.update(codes, new, 1)
+
+    def fit(self):
+        """
+        Returns the fitted tree or None if there aren't foreground and
+        background markers.
+        """
+        fg = self.counts[:, 0] > 0
+        bg = self.counts[:, 1] > 0
+        if not fg.any() or not bg.any():
+            return None
+        X = unpack_codes(np.concatenate((self.codes[fg], self.codes[bg])))
+        y = np.empty(X.shape[0], dtype=np.uint8)
+        y[: fg.sum()] = self.foreground
+        y[fg.sum() :] = self.background
+        weights = np.concatenate((self.counts[fg, 0], self.counts[bg, 1]))
+        clf = DecisionTreeClassifier(max_depth=100)
+        clf.fit(X, y, sample_weight=weights)
+        return clf
+
+    def _build_index(self):
+        # Which codes are present in the volume and in each slab.
+        self.present = np.zeros(NCODES, dtype=bool)
+        self.slabs_present = []
+        slab_present = np.empty(NCODES, dtype=bool)
+        for z in range(0, self.lbp_image.shape[0], self.slab_size):
+            slab_present[:] = False
+            slab_present[pack_codes(self.lbp_image[z : z + self.slab_size])] = True
+            self.present |= slab_present
+            self.slabs_present.append(np.packbits(slab_present))
+
+    def get_lut(self, clf):
+        if self.present is None:
+            self._build_index()
+        codes = np.flatnonzero(self.present).astype(np.uint32)
+        lut = np.zeros(NCODES, dtype=np.uint8)
+        for i in range(0, codes.size, inference.CHUNK_SIZE):
+            chunk = codes[i : i + inference.CHUNK_SIZE]
+            Z = clf.predict(unpack_codes(chunk).astype(np.float32))
+            lut[chunk] = np.where(
+                Z == self.foreground,
+                inference.FOREGROUND_VALUE,
+                inference.BACKGROUND_VALUE,
+            )
+        return lut
+
+    def predict(
+        self, clf, out, bbox=None, is_cancelled=None, planes=(), on_planes=None
+    ):
+        """
+        Writes the prediction of clf in out. Without bbox only the voxels
+        whose code changed class since the last predict are written.
+
+        planes ((orientation, n) tuples, the visible slices) and the planes
+        left dirty by a cancelled predict are written first, only where their
+        class changed, and on_planes is called with the bounding box written
+        there (None if nothing changed). Then the rest of the volume is
+        written in slabs from the axial plane outwards. is_cancelled is
+        checked between slabs, returns False if cancelled. The bounding box of
+        the voxels written in the slabs, out of the planes already reported to
+        on_planes, is kept in self.written.
+        """
+        shape = self.lbp_image.shape[:3]
+        self.written = None
+        lut = self.get_lut(clf)
+        center = inference.get_center(planes, shape[0])
+        if bbox is not None:
+            # Outside bbox out is not in sync with any LUT anymore.
+            self.lut[:] = 0
+            for chunk in inference.iter_chunks(bbox, center=center):
+                if is_cancelled is not None and is_cancelled():
+                    return False
+                out[chunk] = lut[pack_codes(self.lbp_image[chunk])]
+                self.written = inference.union_bbox(self.written, chunk)
+            return True
+
+        changed = lut != self.lut
+        # The dirty planes are repaired even if they aren't shown anymore.
+        planes = self.dirty_planes.union(planes)
+        if planes:
+            planes_written = None
+            for orientation, n in planes:
+                plane = get_plane(out, orientation, n)
+                codes = pack_codes(get_plane(self.lbp_image, orientation, n))
+                if (orientation, n) in self.dirty_planes:
+                    new = np.take(lut, codes)
+                    where = new != plane
+                else:
+                    # In sync with self.lut, only the changed codes differ.
+                    where = np.take(changed, codes)
+                    if not where.any():
+                        continue
+                    new = np.take(lut, codes)
+                    self.dirty_planes.add((orientation, n))
+                np.copyto(plane, new, where=where)
+                written = inference.get_bbox(where)
+                if written is not None:
+                    planes_written = inference.union_bbox(
+                        planes_written,
+                        inference.get_plane_region_bbox(orientation, n, written),
+                    )
+            if on_planes is not None:
+                on_planes(planes_written)
+
+        changed_bits = np.packbits(changed)
+        starts = range(0, self.lbp_image.shape[0], self.slab_size)
+        order = sorted(
+            range(len(starts)),
+            key=lambda i: abs(starts[i] + self.slab_size / 2.0 - center),
+        )
+        for i in order:
+            z = starts[i]
+            if is_cancelled is not None and is_cancelled():
+                return False
+            slab = slice(z, min(z + self.slab_size, shape[0]))
+            if i in self.dirty_slabs:
+                out[slab] = lut[pack_codes(self.lbp_image[slab])]
+                self.written = inference.union_bbox(
+                    self.written, (slab, slice(0, shape[1]), slice(0, shape[2]))
+                )
+                continue
+            if not np.bitwise_and(changed_bits, self.slabs_present[i]).any():
+                continue
+            codes = pack_codes(self.lbp_image[slab])
+            where = np.take(changed, codes)
+            np.copyto(out[slab], np.take(lut, codes), where=where)
+            self.dirty_slabs.add(i)
+            # The planes were already written and redrawn.
+            for orientation, n in planes:
+                if orientation != "AXIAL":
+                    get_plane(where, orientation, n)[:] = False
+                elif z <= n < slab.stop:
+                    where[n - z] = False
+            written = inference.get_bbox(where)
+            if written is not None:
+                sz, sy, sx = written
+                written = (slice(z + sz.start, z + sz.stop), sy, sx)
+                self.written = inference.union_bbox(self.written, written)
+        self.lut = lut
+        self.dirty_slabs.clear()
+        self.dirty_planes.clear()
+        return True
+
+    def reset_prediction(self):
+        self.lut[:] = 0
+        self.dirty_slabs.clear()
+        self.dirty_planes.clear()
@@ -0,0 +1,161 @@
+import itertools
+
+import numpy as np
+
+from .markers import get_plane
+
+CHUNK_SIZE = 2**20
+FOREGROUND_VALUE = 254
+BACKGROUND_VALUE = 1
+
+
+def get_bbox(mask):
+    """
+    Returns the slices of the bounding box of the non zero voxels of mask or
+    None if mask is empty.
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(i for i in range(mask.ndim) if i != axis)
+        (idx,) = np.nonzero(mask.any(axis=other))
+        if idx.size == 0:
+            return None
+        bbox.append(slice(int(idx[0]), int(idx[-1]) + 1))
+    return tuple(bbox)
+
+
+def expand_bbox(bbox, margin, shape):
+    return tuple(
+        slice(max(0, s.start - margin), min(size, s.stop + margin))
+        for s, size in zip(bbox, shape)
+    )
+
+
+def union_bbox(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return tuple(
+        slice(min(i.start, j.start), max(i.stop, j.stop)) for i, j in zip(a, b)
+    )
+
+
+def get_plane_bbox(orientation, n, shape):
+    bbox = [slice(0, i) for i in shape]
+    axis = ("AXIAL", "CORONAL", "SAGITAL").index(orientation)
+    bbox[axis] = slice(n, n + 1)
+    return tuple(bbox)
+
+
+def get_plane_region_bbox(orientation, n, plane_bbox):
+    """
+    The bounding box in the volume of plane_bbox, a bounding box in the plane
+    n of orientation.
+    """
+    bbox = list(plane_bbox)
+    axis = ("AXIAL", "CORONAL", "SAGITAL").index(orientation)
+    bbox.insert(axis, slice(n, n + 1))
+    return tuple(bbox)
+
+
+def get_center(planes, dz):
+    """
+    The axial slice from where the volume is predicted outwards.
+    """
+    for orientation, n in planes:
+        if orientation == "AXIAL":
+            return n
+    return dz // 2
+
+
+def iter_chunks(bbox, chunk_size=CHUNK_SIZE, center=None, tile_shape=None):
+    """
+    Splits bbox in chunks of (about) chunk_size voxels, whole slices when
+    possible, else rows of one slice, or in tiles of tile_shape if given. If
+    center is given the chunks are sorted by their distance to that axial
+    slice.
+    """
+    if center is not None:
+        chunks = list(iter_chunks(bbox, chunk_size, tile_shape=tile_shape))
+        chunks.sort(key=lambda c: abs((c[0].start + c[0].stop - 1) / 2.0 - center))
+        yield from chunks
+        return
+    if tile_shape is not None:
+        ranges = [range(s.start, s.stop, t) for s, t in zip(bbox, tile_shape)]
+        for z, y, x in itertools.product(*ranges):
+            yield tuple(
+                slice(i, min(i + t, s.stop))
+                for i, t, s in zip((z, y, x), tile_shape, bbox)
+            )
+        return
+    sz, sy, sx = bbox
+    dy = sy.stop - sy.start
+    dx = sx.stop - sx.start
+    slice_size = dy * dx
+    if slice_size == 0:
+        return
+    if slice_size <= chunk_size:
+        nz = chunk_size // slice_size
+        for z in range(sz.start, sz.stop, nz):
+            yield (slice(z, min(z + nz, sz.stop)), sy, sx)
+    else:
+        ny = max(1, chunk_size // dx)
+        for z in range(sz.start, sz.stop):
+            for y in range(sy.start, sy.stop, ny):
+                yield (slice(z, z + 1), slice(y, min(y + ny, sy.stop)), sx)
+
+
+def predict(
+    clf,
+    features,
+    out,
+    foreground,
+    bbox=None,
+    chunk_size=CHUNK_SIZE,
+    is_cancelled=None,
+    planes=(),
+    on_planes=None,
+    tile_shape=None,
+):
+    """
+    Classifies the voxels of features ((dz, dy, dx, nfeatures) array) inside
+    bbox (the whole volume if None) chunk by chunk, writing
+    FOREGROUND_VALUE where the class is foreground and BACKGROUND_VALUE
+    elsewhere directly in out. Returns False if is_cancelled() became True.
+
+    Without bbox, planes ((orientation, n) tuples) are classified first and
+    on_planes is called with their bounding box. The chunks are done from the
+    axial plane outwards.
+    tile_shape splits bbox in 3D tiles instead of slabs (see iter_chunks).
+    """
+    center = get_center(planes, out.shape[0])
+    if bbox is None:
+        bbox = tuple(slice(0, i) for i in out.shape)
+        planes_bbox = None
+        for orientation, n in planes:
+            _predict_chunk(
+                clf,
+                get_plane(features, orientation, n),
+                get_plane(out, orientation, n),
+                foreground,
+            )
+            planes_bbox = union_bbox(
+                planes_bbox, get_plane_bbox(orientation, n, out.shape)
+            )
+        if planes and on_planes is not None:
+            on_planes(planes_bbox)
+    for chunk in iter_chunks(bbox, chunk_size, center, tile_shape):
+        if is_cancelled is not None and is_cancelled():
+            return False
+        _predict_chunk(clf, features[chunk], out[chunk], foreground)
+    return True
+
+
+def _predict_chunk(clf, features, out, foreground):
+    X = np.asarray(features, dtype=np.float32)
+    shape = X.shape[:-1]
+    Z = clf.predict(X.reshape(-1, X.shape[-1]))
+    out[:] = np.where(
+        Z.reshape(shape) == foreground, FOREGROUND_VALUE, BACKGROUND_VALUE
+    )
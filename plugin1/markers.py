@@ -0,0 +1,109 @@
+from collections import OrderedDict
+
+import numpy as np
+
+CHUNK_SIZE = 2**24
+
+
+def get_plane(matrix, orientation, n):
+    if orientation == "AXIAL":
+        return matrix[n, :, :]
+    elif orientation == "CORONAL":
+        return matrix[:, n, :]
+    elif orientation == "SAGITAL":
+        return matrix[:, :, n]
+
+
+def get_index_bbox(index, shape):
+    """
+    Returns the slices of the bounding box of the voxels with the given flat
+    indices or None if there are none.
+    """
+    if index.size == 0:
+        return None
+    coords = np.unravel_index(index, shape)
+    return tuple(slice(int(i.min()), int(i.max()) + 1) for i in coords)
+
+
+class MarkerIndex:
+    """
+    Keeps track of the planes of the markers matrix edited since the last
+    call to get_changes. A copy of each plane is saved before its first edit,
+    so the changed voxels are found comparing only those planes.
+
+    The (sorted) flat indices of the voxels of each of labels are kept in
+    voxels and updated with the changes, so the markers are found without
+    scanning the matrix.
+    """
+
+    def __init__(self, matrix, labels=()):
+        self.matrix = matrix
+        self.planes = OrderedDict()
+        self.voxels = {label: [] for label in labels}
+        if labels:
+            flat = matrix.reshape(-1)
+            for i in range(0, flat.size, CHUNK_SIZE):
+                chunk = flat[i : i + CHUNK_SIZE]
+                for label in labels:
+                    self.voxels[label].append(np.flatnonzero(chunk == label) + i)
+        # A zero size matrix has no chunks.
+        self.voxels = {
+            label: np.concatenate(index) if index else np.zeros(0, dtype=np.intp)
+            for label, index in self.voxels.items()
+        }
+
+    def mark_dirty(self, orientation, n):
+        key = (orientation, n)
+        if key not in self.planes:
+            self.planes[key] = np.array(get_plane(self.matrix, orientation, n))
+
+    def get_changes(self):
+        """
+        Returns the flat indices, the old values and the new values of the
+        voxels changed since the last call.
+        """
+        all_index = []
+        all_old = []
+        for (orientation, n), old_plane in self.planes.items():
+            plane = get_plane(self.matrix, orientation, n)
+            a, b = np.nonzero(plane != old_plane)
+            n = np.full(a.shape, n)
+            if orientation == "AXIAL":
+                coords = (n, a, b)
+            elif orientation == "CORONAL":
+                coords = (a, n, b)
+            else:
+                coords = (a, b, n)
+            all_index.append(np.ravel_multi_index(coords, self.matrix.shape))
+            all_old.append(old_plane[a, b])
+        self.planes.clear()
+        if not all_index:
+            return (
+                np.zeros(0, dtype=np.intp),
+                np.zeros(0, dtype=self.matrix.dtype),
+                np.zeros(0, dtype=self.matrix.dtype),
+            )
+        index = np.concatenate(all_index)
+        old = np.concatenate(all_old)
+        # A voxel may be in planes of different orientations, the first plane
+        # saved has its value before any edit.
+        index, first = np.unique(index, return_index=True)
+        old = old[first]
+        new = self.matrix.reshape(-1)[index]
+        changed = old != new
+        index, old, new = index[changed], old[changed], new[changed]
+        self.update_voxels(index, old, new)
+        return index, old, new
+
+    def update_voxels(self, index, old, new):
+        for label, voxels in self.voxels.items():
+            removed = index[old == label]
+            if removed.size:
+                voxels = np.setdiff1d(voxels, removed, assume_unique=True)
+            added = index[new == label]
+            if added.size:
+                voxels = np.union1d(voxels, added)
+            self.voxels[label] = voxels
+
+    def get_voxels(self, label):
+        return self.voxels[label]
@@ -0,0 +1,172 @@
+import threading
+import traceback
+
+import numpy as np
+import wx
+from sklearn.tree import DecisionTreeClassifier
+
+from . import feature_bank
+from . import inference
+from .markers import get_index_bbox
+
+
+class ClassificationJob:
+    def __init__(
+        self,
+        changes,
+        markers,
+        mask,
+        incremental,
+        roi_margin,
+        planes,
+        on_done,
+        features=None,
+    ):
+        self.changes = changes
+        # Flat indices of the voxels of each marker label.
+        self.markers = markers
+        self.mask = mask
+        self.incremental = incremental
+        self.roi_margin = roi_margin
+        # The visible slices, predicted and shown first.
+        self.planes = planes
+        self.on_done = on_done
+        # FeatureBank, if None only the LBP codes are used.
+        self.features = features
+
+
+class ClassificationThread(threading.Thread):
+    """
+    Trains and predicts in background. The jobs submitted while a prediction
+    is running cancel it, and all the pending jobs are done at once: their
+    marker changes are applied to the model and it's fitted and predicted
+    only one time, with the options of the last job.
+
+    The bounding box of the voxels written (also by the cancelled jobs) is
+    passed to on_done, so only the slices shown inside it are redrawn.
+    """
+
+    def __init__(self, model, foreground, background):
+        super().__init__(daemon=True)
+        self.model = model
+        self.foreground = foreground
+        self.background = background
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.generation = 0
+        self.last_mask = None
+        self.written = None
+        self.running = True
+
+    def submit(self, job):
+        with self.condition:
+            self.jobs.append(job)
+            self.generation += 1
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.generation += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.jobs:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                jobs, self.jobs = self.jobs, []
+                generation = self.generation
+
+            def is_cancelled():
+                return self.generation != generation
+
+            try:
+                for job in jobs:
+                    self.model.update_markers(*job.changes)
+                if self.classify(jobs[-1], is_cancelled):
+                    # Nothing left to redraw if only the planes were written.
+                    if self.written is not None:
+                        wx.CallAfter(jobs[-1].on_done, self.written)
+                    self.written = None
+            except Exception:
+                traceback.print_exc()
+
+    def get_roi(self, job):
+        if job.roi_margin is None:
+            return None
+        shape = self.model.lbp_image.shape[:3]
+        bbox = inference.union_bbox(
+            get_index_bbox(job.markers[self.foreground], shape),
+            get_index_bbox(job.markers[self.background], shape),
+        )
+        if bbox is None:
+            return None
+        return inference.expand_bbox(bbox, job.roi_margin, shape)
+
+    def classify(self, job, is_cancelled):
+        model = self.model
+        if job.mask is not self.last_mask:
+            model.reset_prediction()
+            self.last_mask = job.mask
+        out = job.mask.matrix[1:, 1:, 1:]
+
+        def on_planes(bbox):
+            # Only the shown slices crossing what was written are redrawn.
+            if bbox is not None:
+                wx.CallAfter(job.on_done, bbox)
+
+        if job.incremental and job.features is None:
+            clf = model.fit()
+            if clf is None:
+                return False
+            done = model.predict(
+                clf, out, self.get_roi(job), is_cancelled, job.planes, on_planes
+            )
+            self.written = inference.union_bbox(self.written, model.written)
+            return done
+
+        index_marker1 = job.markers[self.foreground]
+        index_marker2 = job.markers[self.background]
+        if index_marker1.size == 0 or index_marker2.size == 0:
+            return False
+        if job.features is None:
+            features = model.lbp_image
+            values_marker1 = features.reshape(-1, 3)[index_marker1]
+            values_marker2 = features.reshape(-1, 3)[index_marker2]
+            tile_shape = None
+        else:
+            features = job.features
+            values_marker1 = features.get_values(index_marker1)
+            values_marker2 = features.get_values(index_marker2)
+            tile_shape = feature_bank.TILE_SHAPE
+        clf_values = np.empty(
+            values_marker1.shape[0] + values_marker2.shape[0], dtype=np.uint8
+        )
+        clf_values[: values_marker1.shape[0]] = self.foreground
+        clf_values[values_marker1.shape[0] :] = self.background
+
+        values_markers = np.concatenate((values_marker1, values_marker2))
+
+        clf = DecisionTreeClassifier(max_depth=100)
+        clf.fit(values_markers, clf_values)
+
+        # The mask is written without the incremental LUT.
+        model.reset_prediction()
+        roi = self.get_roi(job)
+        self.written = inference.union_bbox(
+            self.written, roi or tuple(slice(0, i) for i in out.shape)
+        )
+        return inference.predict(
+            clf,
+            features,
+            out,
+            self.foreground,
+            roi,
+            is_cancelled=is_cancelled,
+            planes=job.planes,
+            on_planes=on_planes,
+            tile_shape=tile_shape,
+        )
@@ -0,0 +1,374 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from . import count
+
+# Above this fraction of the volume in bounding boxes to repaint the whole
+# preview is written at once.
+MAX_REPAINT_FRACTION = 0.125
+# Slices compared at a time with the snapshot to find the edited voxels.
+SLAB_SIZE = 32
+# Slices labelled at a time by SlabComponents.
+STREAM_SLAB_SIZE = 16
+
+
+def get_bbox(mask):
+    """
+    Returns the slices of the bounding box of the non zero voxels of mask or
+    None if mask is empty.
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(i for i in range(mask.ndim) if i != axis)
+        (idx,) = np.nonzero(mask.any(axis=other))
+        if idx.size == 0:
+            return None
+        bbox.append(slice(int(idx[0]), int(idx[-1]) + 1))
+    return tuple(bbox)
+
+
+def expand_bbox(bbox, margin, shape):
+    return tuple(
+        slice(max(0, s.start - margin), min(size, s.stop + margin))
+        for s, size in zip(bbox, shape)
+    )
+
+
+def union_bbox(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return tuple(
+        slice(min(i.start, j.start), max(i.stop, j.stop)) for i, j in zip(a, b)
+    )
+
+
+def pack_mask(mask, slab_size=SLAB_SIZE):
+    """
+    The foreground (> 127) of mask packed in bits along X.
+    """
+    dz, dy, dx = mask.shape
+    packed = np.empty((dz, dy, (dx + 7) // 8), dtype=np.uint8)
+    for z in range(0, dz, slab_size):
+        packed[z : z + slab_size] = np.packbits(mask[z : z + slab_size] > 127, axis=-1)
+    return packed
+
+
+def get_boundary_pairs(last, first, connectivity):
+    """
+    The pairs of labels (2, n) of the connected voxels of two consecutive
+    slices, last (z - 1) and first (z).
+    """
+    dy, dx = first.shape
+    pairs = []
+    neighbours = count.get_neighbours(connectivity)
+    for _dz, oy, ox in neighbours[neighbours[:, 0] == -1]:
+        a = last[max(0, oy) : dy + min(0, oy), max(0, ox) : dx + min(0, ox)]
+        b = first[max(0, -oy) : dy - max(0, oy), max(0, -ox) : dx - max(0, ox)]
+        both = (a > 0) & (b > 0)
+        pairs.append(np.stack((a[both], b[both])))
+    return np.unique(np.concatenate(pairs, axis=1), axis=1)
+
+
+def select_regions(features, max_size, max_volume=0, max_extent=0, keep_border=False):
+    """
+    The regions to remove (a bool per label): the ones with at most max_size
+    voxels, max_volume mm³ and max_extent mm and, with keep_border, not
+    touching the border of the volume. max_volume and max_extent are not
+    used if 0.
+    """
+    size = features["size"]
+    selected = (size > 0) & (size <= max_size)
+    if max_volume > 0:
+        selected &= features["volume"] <= max_volume
+    if max_extent > 0:
+        selected &= features["extent"] <= max_extent
+    if keep_border:
+        selected &= ~features["border"]
+    selected[0] = False
+    return selected
+
+
+def get_edited_bbox(snapshot, mask):
+    """
+    Bounding box of the voxels whose foreground changed since the snapshot
+    (rounded to 8 voxels in X), the snapshot is updated.
+    """
+    bbox = None
+    dz, dy, dx = mask.shape
+    for z in range(0, dz, SLAB_SIZE):
+        packed = pack_mask(mask[z : z + SLAB_SIZE])
+        diff = get_bbox(packed != snapshot[z : z + SLAB_SIZE])
+        if diff is None:
+            continue
+        snapshot[z : z + SLAB_SIZE] = packed
+        sz, sy, sx = diff
+        diff = (
+            slice(z + sz.start, z + sz.stop),
+            sy,
+            slice(8 * sx.start, min(dx, 8 * sx.stop)),
+        )
+        bbox = union_bbox(bbox, diff)
+    return bbox
+
+
+class Regions:
+    """
+    The labelled regions of a mask, sizes and bboxes (z0, z1, y0, y1, x0, x1)
+    by label, the row 0 is the background. The preview shows the selected
+    regions, selected (a bool per label) is what it shows now or None if it
+    must be painted again.
+    """
+
+    @property
+    def num_labels(self):
+        return np.count_nonzero(self.sizes[1:])
+
+    def get_bbox(self, label):
+        z0, z1, y0, y1, x0, x1 = self.bboxes[label]
+        return slice(z0, z1), slice(y0, y1), slice(x0, x1)
+
+    def get_features(self, spacing):
+        """
+        The features of each region: size (voxels), volume (mm³, spacing is
+        x, y, z), extent (the largest side of its bounding box in mm) and
+        border (True if it touches the border of the volume).
+        """
+        spacing = np.asarray(spacing[::-1], dtype=np.float64)
+        sides = self.bboxes[:, 1::2] - self.bboxes[:, ::2]
+        border = (self.bboxes[:, ::2] == 0).any(1)
+        border |= (self.bboxes[:, 1::2] == self.shape).any(1)
+        return {
+            "size": self.sizes,
+            "volume": self.sizes * np.prod(spacing),
+            "extent": (sides * spacing).max(1),
+            "border": border,
+        }
+
+
+class ComponentIndex(Regions):
+    """
+    The regions of a mask with their labels. The preview is updated only in
+    the regions whose selection changed.
+
+    With snapshot (pack_mask of the mask labelled) the index can be updated
+    after the mask is edited, relabelling only the regions touching the
+    edited voxels. The labels of removed regions are left unused (size 0).
+    """
+
+    def __init__(self, labels, sizes, bboxes, snapshot=None, connectivity=6):
+        self.labels = labels
+        self.sizes = sizes
+        self.bboxes = bboxes
+        self.snapshot = snapshot
+        self.connectivity = connectivity
+        self.shape = labels.shape
+        self.selected = None
+
+    def update_preview(self, preview, selected):
+        """
+        Writes 255 in preview in the selected regions and 0 elsewhere.
+        Returns False if nothing changed.
+        """
+        if self.selected is None:
+            self.paint(preview, selected)
+            return True
+        changed = np.flatnonzero(selected != self.selected)
+        bboxes = self.bboxes[changed]
+        volume = np.prod(bboxes[:, 1::2] - bboxes[:, ::2], axis=1).sum()
+        if volume > MAX_REPAINT_FRACTION * self.labels.size:
+            self.paint(preview, selected)
+            return True
+        for label in changed:
+            bbox = self.get_bbox(label)
+            preview[bbox][self.labels[bbox] == label] = 255 if selected[label] else 0
+        self.selected = selected
+        return changed.size > 0
+
+    def paint(self, preview, selected, bbox=None):
+        lut = np.where(selected, 255, 0).astype(np.uint8)
+        lut[0] = 0
+        if bbox is None:
+            np.take(lut, self.labels, out=preview)
+            self.selected = selected
+        else:
+            preview[bbox] = np.take(lut, self.labels[bbox])
+
+    def update(self, mask, preview=None):
+        """
+        Updates the labels after mask was edited, only the regions touching
+        the edited voxels are labelled again (merging and splitting). In the
+        preview, if given, the new regions are shown as not selected until
+        the next update_preview. Returns the bounding box relabelled or None
+        if the mask foreground didn't change.
+        """
+        edited = get_edited_bbox(self.snapshot, mask)
+        if edited is None:
+            return None
+        edited = expand_bbox(edited, 1, self.shape)
+        affected = np.unique(self.labels[edited])
+        affected = affected[affected > 0]
+        bboxes = self.bboxes[affected]
+        bbox = tuple(
+            slice(
+                min([s.start] + list(bboxes[:, 2 * axis])),
+                max([s.stop] + list(bboxes[:, 2 * axis + 1])),
+            )
+            for axis, s in enumerate(edited)
+        )
+
+        labels = self.labels[bbox]
+        old = np.isin(labels, affected)
+        # The old regions touching the edit and the new voxels, the other
+        # regions in bbox are not connected to them.
+        region = (mask[bbox] > 127) & (old | (labels == 0))
+        new_labels, new_sizes, new_bboxes = count.label_regions(
+            np.where(region, np.uint8(255), np.uint8(0)), self.connectivity
+        )
+
+        # The labels of the affected regions are reused first.
+        nnew = new_sizes.size - 1
+        extra = max(0, nnew - affected.size)
+        if extra:
+            self.sizes = np.concatenate((self.sizes, np.zeros(extra, np.int64)))
+            self.bboxes = np.concatenate(
+                (self.bboxes, np.zeros((extra, 6), self.bboxes.dtype))
+            )
+        ids = np.concatenate(
+            (affected, np.arange(self.sizes.size - extra, self.sizes.size))
+        )[:nnew].astype(self.labels.dtype)
+        self.sizes[affected] = 0
+        self.bboxes[affected] = 0
+        self.sizes[ids] = new_sizes[1:]
+        offset = np.repeat([s.start for s in bbox], 2)
+        self.bboxes[ids] = new_bboxes[1:] + offset
+        self.sizes[0] = self.labels.size - self.sizes[1:].sum()
+
+        lut = np.concatenate(([0], ids))
+        labels[old] = 0
+        labels[region] = lut[new_labels[region]]
+        if preview is None:
+            self.selected = None
+        elif self.selected is not None:
+            selected = np.zeros(self.sizes.size, dtype=bool)
+            selected[: self.selected.size] = self.selected
+            selected[affected] = False
+            self.selected = selected
+            self.paint(preview, selected, bbox)
+        return bbox
+
+
+class SlabComponents(Regions):
+    """
+    The regions of a mask too big to keep its labels in memory. The mask is
+    labelled in slabs of slab_size slices, the labels of each slab are
+    joined to the ones they touch in the previous slab (union-find over the
+    boundary faces) and only the global region of each slab label, the
+    sizes and bounding boxes are kept. The preview is painted labelling the
+    slabs again, one at a time.
+
+    It has the same interface as ComponentIndex used by the gui, but the
+    preview is always painted whole.
+    """
+
+    def __init__(self, mask, slab_size=STREAM_SLAB_SIZE, connectivity=6):
+        self.mask = mask
+        self.slab_size = slab_size
+        self.connectivity = connectivity
+        self.shape = mask.shape
+        self.snapshot = pack_mask(mask)
+        self.selected = None
+        self._label()
+
+    def _label(self):
+        mask = self.mask
+        # Slab labels get global ids starting at offset + 1, 0 is background.
+        self.offsets = []
+        self.counts = []
+        sizes = [np.zeros(1, dtype=np.int64)]
+        bboxes = [np.zeros((1, 6), dtype=np.int32)]
+        edges = []
+        last = None
+        n = 0
+        for z in range(0, mask.shape[0], self.slab_size):
+            labels, slab_sizes, slab_bboxes = count.label_regions(
+                np.ascontiguousarray(mask[z : z + self.slab_size]), self.connectivity
+            )
+            nlabels = slab_sizes.size - 1
+            if last is not None:
+                first = np.where(labels[0] > 0, labels[0] + n, 0)
+                edges.append(get_boundary_pairs(last, first, self.connectivity))
+            last = np.where(labels[-1] > 0, labels[-1] + n, 0)
+            slab_bboxes = slab_bboxes[1:]
+            slab_bboxes[:, :2] += z
+            sizes.append(slab_sizes[1:])
+            bboxes.append(slab_bboxes)
+            self.offsets.append(n)
+            self.counts.append(nlabels)
+            n += nlabels
+        edges = np.concatenate(edges, axis=1) if edges else np.zeros((2, 0), int)
+        graph = coo_matrix(
+            (np.ones(edges.shape[1], dtype=np.int8), tuple(edges)), shape=(n + 1, n + 1)
+        )
+        _ncomponents, component = connected_components(graph, directed=False)
+        # Regions numbered by their first slab label, the background is 0.
+        _ids, first, inverse = np.unique(
+            component, return_index=True, return_inverse=True
+        )
+        self.component = np.argsort(np.argsort(first))[inverse].astype(np.int32)
+        nregions = first.size
+
+        sizes = np.concatenate(sizes)
+        bboxes = np.concatenate(bboxes)
+        self.sizes = np.zeros(nregions, dtype=np.int64)
+        np.add.at(self.sizes, self.component, sizes)
+        self.sizes[0] = mask.size - self.sizes[1:].sum()
+        self.bboxes = np.zeros((nregions, 6), dtype=np.int32)
+        self.bboxes[1:, ::2] = np.iinfo(np.int32).max
+        np.minimum.at(self.bboxes[:, ::2], self.component[1:], bboxes[1:, ::2])
+        np.maximum.at(self.bboxes[:, 1::2], self.component[1:], bboxes[1:, 1::2])
+        self.bboxes[0] = 0, mask.shape[0], 0, mask.shape[1], 0, mask.shape[2]
+
+    def iter_slabs(self):
+        """
+        Yields the slices of each slab, its labels and the region of each
+        label (lut[labels] are the global labels).
+        """
+        for z, offset, nlabels in zip(
+            range(0, self.mask.shape[0], self.slab_size), self.offsets, self.counts
+        ):
+            slab = slice(z, min(z + self.slab_size, self.mask.shape[0]))
+            labels, _sizes, _bboxes = count.label_regions(
+                np.ascontiguousarray(self.mask[slab]), self.connectivity
+            )
+            lut = self.component[offset : offset + nlabels + 1].copy()
+            lut[0] = 0
+            yield slab, labels, lut
+
+    def update_preview(self, preview, selected):
+        if self.selected is not None and (selected == self.selected).all():
+            return False
+        self.paint(preview, selected)
+        return True
+
+    def paint(self, preview, selected):
+        selected_lut = np.where(selected, 255, 0).astype(np.uint8)
+        selected_lut[0] = 0
+        for slab, labels, lut in self.iter_slabs():
+            np.take(selected_lut[lut], labels, out=preview[slab])
+        self.selected = selected
+
+    def update(self, mask, preview=None):
+        """
+        Labels mask again if its foreground changed since the last time, the
+        preview is painted in the next update_preview. Returns the whole
+        volume bounding box or None if nothing changed.
+        """
+        if get_edited_bbox(self.snapshot, mask) is None:
+            return None
+        self.mask = mask
+        self._label()
+        self.selected = None
+        return tuple(slice(0, i) for i in mask.shape)
@@ -4,6 +4,7 @@ import numpy as np
 cimport numpy as np
 cimport cython
 from cython.parallel import prange
+cimport openmp
 from libcpp.vector cimport vector
 from libcpp cimport bool
 
@@ -40,3 +41,223 @@ def count_regions(label_t[:, :, :] image, int number_regions):
     cdef np.uint32_t[:, :, :] out = np.zeros_like(image, dtype=np.uint32)
     _count(image, number_regions, out)
     return np.asarray(out)
+
+
+def get_neighbours(int connectivity):
+    """
+    The offsets (dz, dy, dx) of the neighbours of a voxel scanned before it,
+    for 6, 18 or 26-connectivity.
+    """
+    if connectivity not in (6, 18, 26):
+        raise ValueError(f"Invalid connectivity {connectivity}")
+    neighbours = []
+    for dz in (-1, 0):
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                if (dz, dy, dx) >= (0, 0, 0):
+                    continue
+                n = abs(dz) + abs(dy) + abs(dx)
+                if n == 1 or (n == 2 and connectivity >= 18) or connectivity == 26:
+                    neighbours.append((dz, dy, dx))
+    return np.array(neighbours, dtype=np.int32)
+
+
+cdef inline np.int64_t _find(vector[np.int64_t]& parent, np.int64_t i) nogil:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+cdef inline np.int64_t _union(vector[np.int64_t]& parent, np.int64_t a, np.int64_t b) nogil:
+    # The root is always the smallest label, so labels are numbered in the
+    # order their first voxel appears.
+    if a == 0:
+        return _find(parent, b)
+    a = _find(parent, a)
+    b = _find(parent, b)
+    if a < b:
+        parent[b] = a
+        return a
+    parent[a] = b
+    return b
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.cdivision(True)
+@cython.wraparound(False)
+cdef np.int64_t _label_slab(np.uint8_t[:, :, :] mask, np.int32_t[:, :, :] labels, np.int32_t[:, :] neighbours, int z0, int z1, vector[np.int64_t]& parent, vector[np.int64_t]& sizes, vector[int]& bboxes) nogil:
+    # Gives provisional labels (1, 2, ...) to the voxels of the slab [z0, z1),
+    # the equivalent ones are merged in parent, and counts the voxels of each
+    # one in sizes and their bounding box (z0, z1, y0, y1, x0, x1, inclusive)
+    # in bboxes. Returns the number of provisional labels.
+    cdef int x, y, z, k, nx, ny, nz
+    cdef int dx, dy
+    cdef np.int64_t label
+    cdef np.int64_t n = 0
+    cdef int* bbox
+
+    dy = mask.shape[1]
+    dx = mask.shape[2]
+
+    parent.push_back(0)
+    sizes.push_back(0)
+    bboxes.resize(6)
+    for z in range(z0, z1):
+        for y in range(dy):
+            for x in range(dx):
+                if mask[z, y, x] <= 127:
+                    continue
+                label = 0
+                for k in range(neighbours.shape[0]):
+                    nz = z + neighbours[k, 0]
+                    ny = y + neighbours[k, 1]
+                    nx = x + neighbours[k, 2]
+                    if nz < z0 or ny < 0 or ny >= dy or nx < 0 or nx >= dx:
+                        continue
+                    if labels[nz, ny, nx]:
+                        label = _union(parent, label, labels[nz, ny, nx])
+                if label == 0:
+                    n += 1
+                    parent.push_back(n)
+                    sizes.push_back(0)
+                    bboxes.push_back(z)
+                    bboxes.push_back(z)
+                    bboxes.push_back(y)
+                    bboxes.push_back(y)
+                    bboxes.push_back(x)
+                    bboxes.push_back(x)
+                    label = n
+                labels[z, y, x] = label
+                sizes[label] += 1
+                # Scanned in order, so z and y only grow.
+                bbox = &bboxes[6 * label]
+                bbox[1] = z
+                if y < bbox[2]: bbox[2] = y
+                if y > bbox[3]: bbox[3] = y
+                if x < bbox[4]: bbox[4] = x
+                if x > bbox[5]: bbox[5] = x
+    return n
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.cdivision(True)
+@cython.wraparound(False)
+cdef void _relabel_slab(np.int32_t[:, :, :] labels, np.int32_t[:] lut, np.int64_t offset, int z0, int z1) nogil:
+    cdef int x, y, z
+    for z in range(z0, z1):
+        for y in range(labels.shape[1]):
+            for x in range(labels.shape[2]):
+                if labels[z, y, x]:
+                    labels[z, y, x] = lut[offset + labels[z, y, x]]
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.cdivision(True)
+@cython.wraparound(False)
+def label_regions(np.uint8_t[:, :, :] mask, int connectivity=6, int slab_size=0):
+    """
+    Labels the connected regions (6, 18 or 26-connectivity) of the voxels >
+    127 of mask and counts their voxels at the same time. The Z slabs are labelled in
+    parallel, each with its own union-find, and then merged through their
+    boundaries. Returns the labels (int32, numbered like nd.label), the size
+    of each label (sizes[0] is the number of background voxels) and their
+    bounding boxes, a (nlabels + 1, 6) array of z0, z1, y0, y1, x0, x1 (the
+    stops exclusive).
+    """
+    cdef int dz = mask.shape[0]
+    cdef int dy = mask.shape[1]
+    cdef int dx = mask.shape[2]
+    cdef int nslabs, nthreads, s, x, y, z, k, nx, ny
+    cdef np.int64_t i, a, b, total, nlabels
+
+    cdef np.int32_t[:, :] neighbours = get_neighbours(connectivity)
+    cdef np.int32_t[:, :, :] labels = np.zeros((dz, dy, dx), dtype=np.int32)
+
+    if slab_size <= 0:
+        nthreads = 4 * openmp.omp_get_max_threads()
+        slab_size = max(1, (dz + nthreads - 1) // nthreads)
+    # The provisional labels of a slab must fit in int32.
+    slab_size = max(1, min(slab_size, (2**31 - 1) // max(1, dy * dx)))
+    nslabs = max(1, (dz + slab_size - 1) // slab_size)
+
+    cdef vector[vector[np.int64_t]] parents
+    cdef vector[vector[np.int64_t]] slab_sizes
+    cdef vector[vector[int]] slab_bboxes
+    cdef vector[np.int64_t] counts
+    cdef vector[np.int64_t] offsets
+    cdef vector[np.int64_t] parent
+    parents.resize(nslabs)
+    slab_sizes.resize(nslabs)
+    slab_bboxes.resize(nslabs)
+    counts.resize(nslabs)
+    offsets.resize(nslabs)
+
+    with nogil:
+        for s in prange(nslabs, schedule="dynamic"):
+            counts[s] = _label_slab(mask, labels, neighbours, s * slab_size, min((s + 1) * slab_size, dz), parents[s], slab_sizes[s], slab_bboxes[s])
+
+    # Global labels: the ones of slab s start after offsets[s].
+    total = 0
+    for s in range(nslabs):
+        offsets[s] = total
+        total += counts[s]
+    parent.resize(total + 1)
+    parent[0] = 0
+    for s in range(nslabs):
+        for i in range(1, counts[s] + 1):
+            parent[offsets[s] + i] = offsets[s] + _find(parents[s], i)
+        parents[s].clear()
+        parents[s].shrink_to_fit()
+
+    # Merging the regions that cross the slab boundaries.
+    for s in range(1, nslabs):
+        z = s * slab_size
+        for y in range(dy):
+            for x in range(dx):
+                b = labels[z, y, x]
+                if not b:
+                    continue
+                for k in range(neighbours.shape[0]):
+                    if neighbours[k, 0] == 0:
+                        continue
+                    ny = y + neighbours[k, 1]
+                    nx = x + neighbours[k, 2]
+                    if ny < 0 or ny >= dy or nx < 0 or nx >= dx:
+                        continue
+                    a = labels[z - 1, ny, nx]
+                    if a:
+                        _union(parent, offsets[s - 1] + a, offsets[s] + b)
+
+    cdef np.int32_t[:] lut = np.zeros(total + 1, dtype=np.int32)
+    nlabels = 0
+    for i in range(1, total + 1):
+        a = _find(parent, i)
+        if a == i:
+            nlabels += 1
+            lut[i] = nlabels
+        else:
+            lut[i] = lut[a]
+
+    cdef np.int64_t[:] sizes = np.zeros(nlabels + 1, dtype=np.int64)
+    cdef np.int32_t[:, :] bboxes = np.empty((nlabels + 1, 6), dtype=np.int32)
+    bboxes[:, ::2] = np.int32(2**31 - 1)
+    bboxes[:, 1::2] = -1
+    for s in range(nslabs):
+        for i in range(1, counts[s] + 1):
+            a = lut[offsets[s] + i]
+            sizes[a] += slab_sizes[s][i]
+            for x in range(0, 6, 2):
+                bboxes[a, x] = min(bboxes[a, x], slab_bboxes[s][6 * i + x])
+                bboxes[a, x + 1] = max(bboxes[a, x + 1], slab_bboxes[s][6 * i + x + 1] + 1)
+    sizes[0] = <np.int64_t>dz * dy * dx - np.asarray(sizes).sum()
+    bboxes[0, ::2] = 0
+    bboxes[0, 1] = dz
+    bboxes[0, 3] = dy
+    bboxes[0, 5] = dx
+
+    with nogil:
+        for s in prange(nslabs, schedule="dynamic"):
+            _relabel_slab(labels, lut, offsets[s], s * slab_size, min((s + 1) * slab_size, dz))
+
+    return np.asarray(labels), np.asarray(sizes), np.asarray(bboxes)
@@ -8,9 +8,14 @@ import wx
 from invesalius import project
 from pubsub import pub as Publisher
 
+from . import components
 from . import count
+from . import slice_buffers
 
 INIT_MIN_SIZE = "10"
+CONNECTIVITIES = ("6", "18", "26")
+# Masks with more voxels are labelled in slabs, without keeping the labels.
+MAX_LABELS_SIZE = 512**3
 
 
 class Window(wx.Dialog):
@@ -25,6 +30,7 @@ class Window(wx.Dialog):
 
         self.mask = None
         self.preview_matrix = None
+        self.components = None
 
         self._init_gui()
         self._bind_events()
@@ -34,48 +40,92 @@ class Window(wx.Dialog):
             self.mask.add_modified_callback(self.on_modified_mask)
 
     def _find_regions(self, matrix):
-        labels, num_labels = nd.label(matrix)
-        return labels, num_labels
+        connectivity = int(self.choice_connectivity.GetStringSelection())
+        if matrix.size > MAX_LABELS_SIZE:
+            return components.SlabComponents(matrix, connectivity=connectivity)
+        labels, sizes, bboxes = count.label_regions(matrix, connectivity)
+        return components.ComponentIndex(
+            labels, sizes, bboxes, components.pack_mask(matrix), connectivity
+        )
 
     def _find_regions_actual_mask(self):
         s = slc.Slice()
         self.mask = s.current_mask
         if self.mask:
             s.do_threshold_to_all_slices()
-            labels, num_labels = self._find_regions(self.mask.matrix[1:, 1:, 1:])
-            counts = count.count_regions(labels, num_labels)
-            self.txt_num_regions.SetValue(str(num_labels))
+            self.components = self._find_regions(self.mask.matrix[1:, 1:, 1:])
+            self.txt_num_regions.SetValue(str(self.components.num_labels))
 
             if self.preview_matrix is None:
                 _tmp, self.preview_matrix = self.create_temp_mask()
 
-            self.counts = counts
-            self.num_labels = num_labels
             s.aux_matrices["REMOVE_TINY"] = self.preview_matrix
             s.to_show_aux = "REMOVE_TINY"
 
             self._update_preview_matrix()
 
     def _update_preview_matrix(self):
-        min_size = self.txt_min_size.GetValue()
-        self.preview_matrix[:] = (self.counts <= min_size) * 255
-        Publisher.sendMessage("Reload actual slice")
+        if self.components is None:
+            return
+        features = self.components.get_features(slc.Slice().spacing)
+        selected = components.select_regions(
+            features,
+            self.txt_min_size.GetValue(),
+            self.txt_max_volume.GetValue(),
+            self.txt_max_extent.GetValue(),
+            self.chk_keep_border.GetValue(),
+        )
+        # Only the regions whose selection changed are painted again.
+        if self.components.update_preview(self.preview_matrix, selected):
+            Publisher.sendMessage("Reload actual slice")
 
     def _init_gui(self):
+        self.choice_connectivity = wx.Choice(self, -1, choices=CONNECTIVITIES)
+        self.choice_connectivity.SetSelection(0)
+
         self.txt_min_size = wx.SpinCtrl(
             self, -1, value=INIT_MIN_SIZE, min=1, max=10 ** 10
         )
+        self.txt_max_volume = wx.SpinCtrlDouble(
+            self, -1, initial=0, min=0, max=10 ** 10, inc=1
+        )
+        self.txt_max_extent = wx.SpinCtrlDouble(
+            self, -1, initial=0, min=0, max=10 ** 10, inc=1
+        )
+        self.chk_keep_border = wx.CheckBox(
+            self, -1, "Keep regions touching the border"
+        )
 
         self.txt_num_regions = wx.TextCtrl(self, -1, "0")
 
         self.btn_remove = wx.Button(self, -1, "Remove")
 
         sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(wx.StaticText(self, -1, "Connectivity"), 0, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(self.choice_connectivity, 1, wx.EXPAND | wx.ALL, 5)
+
         sizer.Add(
             wx.StaticText(self, -1, "Maximum size to remove"), 0, wx.EXPAND | wx.ALL, 5
         )
         sizer.Add(self.txt_min_size, 1, wx.EXPAND | wx.ALL, 5)
 
+        sizer.Add(
+            wx.StaticText(self, -1, "Maximum volume to remove (mm³, 0 for any)"),
+            0,
+            wx.EXPAND | wx.ALL,
+            5,
+        )
+        sizer.Add(self.txt_max_volume, 1, wx.EXPAND | wx.ALL, 5)
+
+        sizer.Add(
+            wx.StaticText(self, -1, "Maximum extent to remove (mm, 0 for any)"),
+            0,
+            wx.EXPAND | wx.ALL,
+            5,
+        )
+        sizer.Add(self.txt_max_extent, 1, wx.EXPAND | wx.ALL, 5)
+        sizer.Add(self.chk_keep_border, 0, wx.EXPAND | wx.ALL, 5)
+
         sizer.Add(
             wx.StaticText(self, -1, "Number of regions"), 0, wx.EXPAND | wx.ALL, 5
         )
@@ -88,7 +138,11 @@ class Window(wx.Dialog):
         self.Layout()
 
     def _bind_events(self):
-        self.txt_min_size.Bind(wx.EVT_SPINCTRL, self.OnSetMinSize)
+        self.choice_connectivity.Bind(wx.EVT_CHOICE, self.OnSetConnectivity)
+        self.txt_min_size.Bind(wx.EVT_SPINCTRL, self.OnSetFilter)
+        self.txt_max_volume.Bind(wx.EVT_SPINCTRLDOUBLE, self.OnSetFilter)
+        self.txt_max_extent.Bind(wx.EVT_SPINCTRLDOUBLE, self.OnSetFilter)
+        self.chk_keep_border.Bind(wx.EVT_CHECKBOX, self.OnSetFilter)
         self.btn_remove.Bind(wx.EVT_BUTTON, self.OnRemove)
         self.Bind(wx.EVT_CLOSE, self.OnClose)
 
@@ -100,12 +154,25 @@ class Window(wx.Dialog):
         )
         return temp_file, matrix
 
-    def OnSetMinSize(self, evt):
+    def OnSetFilter(self, evt):
         self._update_preview_matrix()
 
+    def OnSetConnectivity(self, evt):
+        self._find_regions_actual_mask()
+
     def on_modified_mask(self):
         print("On modified mask")
-        self._find_regions_actual_mask()
+        s = slc.Slice()
+        if self.components is None or self.mask is not s.current_mask:
+            self._find_regions_actual_mask()
+            self._update_preview_matrix()
+            return
+        # Only the regions touching the edited voxels are labelled again.
+        s.do_threshold_to_all_slices()
+        bbox = self.components.update(self.mask.matrix[1:, 1:, 1:], self.preview_matrix)
+        if bbox is not None:
+            self.txt_num_regions.SetValue(str(self.components.num_labels))
+            Publisher.sendMessage("Reload actual slice")
         self._update_preview_matrix()
 
     def OnClose(self, evt):
@@ -134,11 +201,17 @@ class Window(wx.Dialog):
     def OnRemove(self, evt):
         if self.mask and self.preview_matrix is not None:
             s = slc.Slice()
-            s.discard_all_buffers()
+            removed = self.preview_matrix > 127
+            bbox = nd.find_objects(removed.view(np.uint8))
+            if not bbox:
+                return
             cp_mask = self.mask.matrix.copy()
             m = self.mask.matrix[1:, 1:, 1:]
-            m[self.preview_matrix > 127] = 1
+            m[removed] = 1
             self.mask.was_edited = True
-            self.preview_matrix[:] = 0
+            self.components.update(m, self.preview_matrix)
+            self._update_preview_matrix()
+            self.txt_num_regions.SetValue(str(self.components.num_labels))
             self.mask.save_history(0, 'VOLUME', self.mask.matrix.copy(), cp_mask)
+            slice_buffers.discard_buffers(s, bbox[0])
             Publisher.sendMessage("Reload actual slice")
@@ -0,0 +1,86 @@
+"""
+Compares texture_floodfill_parallel against the serial texture_floodfill and
+times texture_floodfill_adaptive (--confidence).
+Build the extensions first and run it from this folder:
+
+    python setup.py build_ext --inplace
+    python benchmark_floodfill.py --sizes 256 512
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, generate_binary_structure
+
+from floodfill import (
+    texture_floodfill,
+    texture_floodfill_adaptive,
+    texture_floodfill_parallel,
+)
+from simple_lbp import simple_lbp
+
+
+def create_image(size):
+    z, y, x = np.ogrid[:size, :size, :size]
+    c = size / 2.0
+    r = size / 3.0
+    image = 300.0 * (((x - c) ** 2 + (y - c) ** 2 + (z - c) ** 2) < r**2)
+    image += np.random.normal(0, 20, (size, size, size))
+    return image.astype(np.int16)
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - t0, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=(256, 512))
+    parser.add_argument("--connectivity", type=int, default=1, choices=(1, 2, 3))
+    parser.add_argument("--confidence", type=float, default=2.0)
+    args = parser.parse_args()
+
+    strct = np.array(
+        generate_binary_structure(3, args.connectivity), dtype=np.uint8
+    )
+    for size in args.sizes:
+        lbp_image = simple_lbp(gaussian_filter(create_image(size), 1.5))
+        mask = np.zeros(lbp_image.shape[:3], dtype=np.uint8)
+        c = size // 2
+        mask[c, c - 5 : c + 5, c - 5 : c + 5] = 1
+        values = lbp_image[mask == 1]
+        mean = values.mean(0, dtype=np.float32)
+        max_dist = np.linalg.norm(values - mean, axis=1).mean()
+        print(f"Size: {size}^3")
+
+        t, reference = timeit(
+            texture_floodfill, lbp_image, mask, mean, 1, max_dist, strct
+        )
+        print(f"texture_floodfill: {t:.2f}s, filled: {reference.sum()}")
+
+        t, out = timeit(
+            texture_floodfill_parallel, lbp_image, mask, mean, 1, max_dist, strct
+        )
+        print(
+            f"texture_floodfill_parallel: {t:.2f}s, "
+            f"equal: {np.array_equal(out, reference)}"
+        )
+
+        t, out = timeit(
+            texture_floodfill_adaptive,
+            lbp_image,
+            mask,
+            mean,
+            1,
+            max_dist,
+            args.confidence,
+            strct,
+        )
+        print(f"texture_floodfill_adaptive: {t:.2f}s, filled: {out.sum()}")
+        del lbp_image, reference, out
+
+
+if __name__ == "__main__":
+    main()
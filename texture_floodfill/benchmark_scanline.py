@@ -0,0 +1,88 @@
+"""
+Compares the scanline floodfill_threshold and floodfill_auto_threshold against
+the ones pushing each voxel. Build the extensions first and run it from this
+folder:
+
+    python setup.py build_ext --inplace
+    python benchmark_scanline.py --sizes 256 512
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+from scipy.ndimage import generate_binary_structure
+
+from floodfill import (
+    floodfill_auto_threshold,
+    floodfill_auto_threshold_scanline,
+    floodfill_threshold,
+    floodfill_threshold_scanline,
+)
+
+
+def create_image(size):
+    z, y, x = np.ogrid[:size, :size, :size]
+    c = size / 2.0
+    r = size / 3.0
+    image = 300.0 * (((x - c) ** 2 + (y - c) ** 2 + (z - c) ** 2) < r**2)
+    image += np.random.normal(0, 20, (size, size, size))
+    return image.astype(np.int16)
+
+
+def count_runs(mask):
+    # Runs along X, the number of items the scanline version pushes.
+    starts = mask[..., 1:] & ~mask[..., :-1]
+    return int(mask[..., 0].sum() + starts.sum())
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.perf_counter()
+    # floodfill_auto_threshold prints the seeds.
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args, **kwargs)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=(256, 512))
+    parser.add_argument("--connectivity", type=int, default=1, choices=(1, 2, 3))
+    args = parser.parse_args()
+
+    strct = np.array(
+        generate_binary_structure(3, args.connectivity), dtype=np.uint8
+    )
+    for size in args.sizes:
+        image = create_image(size)
+        c = size // 2
+        seeds = [(c, c, c)]
+        print(f"Size: {size}^3")
+
+        reference = np.zeros(image.shape, dtype=np.uint8)
+        t = timeit(floodfill_threshold, image, seeds, 200, 400, 1, strct, reference)
+        print(f"floodfill_threshold: {t:.2f}s, filled: {reference.sum()}")
+        out = np.zeros(image.shape, dtype=np.uint8)
+        t = timeit(
+            floodfill_threshold_scanline, image, seeds, 200, 400, 1, strct, out
+        )
+        print(
+            f"floodfill_threshold_scanline: {t:.2f}s, "
+            f"runs: {count_runs(out == 1)}, equal: {np.array_equal(out, reference)}"
+        )
+
+        reference[:] = 0
+        t = timeit(floodfill_auto_threshold, image, seeds, 0.2, 1, reference)
+        print(f"floodfill_auto_threshold: {t:.2f}s, filled: {reference.sum()}")
+        out[:] = 0
+        t = timeit(floodfill_auto_threshold_scanline, image, seeds, 0.2, 1, out)
+        print(
+            f"floodfill_auto_threshold_scanline: {t:.2f}s, "
+            f"runs: {count_runs(out == 1)}, equal: {np.array_equal(out, reference)}"
+        )
+        del image, reference, out
+
+
+if __name__ == "__main__":
+    main()
@@ -10,12 +10,12 @@ import invesalius.utils as utils
 from invesalius.data import styles
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.ensemble import RandomForestClassifier
-from scipy.ndimage import generate_binary_structure, gaussian_filter
+from scipy.ndimage import generate_binary_structure
 
-import imageio
-
-from . import simple_lbp
-from . import floodfill
+from . import feature_cache
+from . import features
+from . import markers
+from . import slice_buffers
 
 BRUSH_FOREGROUND = 1
 BRUSH_BACKGROUND = 2
@@ -41,6 +41,9 @@ class ClassificationConfig(with_metaclass(utils.Singleton, object)):
         self.operation = BRUSH_FOREGROUND
         self.cursor_type = const.BRUSH_CIRCLE
         self.cursor_size = const.BRUSH_SIZE
+        # If set the region mean and spread are updated while it grows and
+        # the voxels within confidence times the spread are accepted.
+        self.confidence = None
 
         Publisher.subscribe(self.set_operation, "Set watershed operation")
         Publisher.subscribe(self.set_use_ww_wl, "Set use ww wl")
@@ -49,6 +52,7 @@ class ClassificationConfig(with_metaclass(utils.Singleton, object)):
         Publisher.subscribe(self.set_2dcon, "Set watershed 2d con")
         Publisher.subscribe(self.set_3dcon, "Set watershed 3d con")
         Publisher.subscribe(self.set_gaussian_size, "Set watershed gaussian size")
+        Publisher.subscribe(self.set_confidence, "Set texture floodfill confidence")
 
     def set_operation(self, operation):
         self.operation = WATERSHED_OPERATIONS[operation]
@@ -68,17 +72,30 @@ class ClassificationConfig(with_metaclass(utils.Singleton, object)):
     def set_gaussian_size(self, size):
         self.mg_size = size
 
+    def set_confidence(self, confidence):
+        self.confidence = confidence
+
 
 class Classifier(with_metaclass(utils.Singleton, object)):
     def __init__(self):
         self.clf = RandomForestClassifier()
         self.image = None
-        self.lbp_image = None
+        self.features = None
+        # The mask the region was written to, grown incrementally.
+        self.mask = None
+        # The markers index, shared by the viewers since they all paint the
+        # same markers matrix.
+        self.markers = None
         self.gx = None
         self.gy = None
         self.gz = None
         self.gm = None
 
+    def get_markers(self, matrix, labels):
+        if self.markers is None or self.markers.matrix is not matrix:
+            self.markers = markers.MarkerIndex(matrix, labels)
+        return self.markers
+
 
 class ClassificationStyle(styles.BaseImageEditionInteractorStyle):
     def __init__(self, viewer):
@@ -87,27 +104,32 @@ class ClassificationStyle(styles.BaseImageEditionInteractorStyle):
         self.viewer = viewer
         self.orientation = self.viewer.orientation
         self.matrix = None
+        self.markers = None
         self.fill_value = BRUSH_FOREGROUND
         self.config = ClassificationConfig()
         self.classifier = Classifier()
 
-        if self.classifier.image is None:
-            image = gaussian_filter(self.viewer.slice_.matrix, 1.5)
-            #  gz, gy, gx = np.gradient(image)
-            #  gm = np.sqrt(gx**2 + gy**2 + gz**2)
-            #  self.classifier.gx = np.nan_to_num(gx / gm)
-            #  self.classifier.gy = np.nan_to_num(gy / gm)
-            #  self.classifier.gz = np.nan_to_num(gz / gm)
-            #  self.classifier.gm = gm
-            self.classifier.image = image
-            self.classifier.lbp_image = simple_lbp.simple_lbp(image)
-
-            imageio.imsave(
-                "/tmp/saida.png", self.classifier.lbp_image[image.shape[0] // 2]
+        if self.classifier.image is not self.viewer.slice_.matrix:
+            # The gaussian and LBP are only computed for the blocks touched by
+            # the floodfill.
+            matrix = self.viewer.slice_.matrix
+            key = feature_cache.get_key(
+                matrix, "gaussian_lbp", features.SIGMA, features.BLOCK_SHAPE
+            )
+            store, computed = feature_cache.open_features(
+                key,
+                matrix.shape + (3,),
+                np.uint8,
+                features.get_nblocks(matrix.shape, features.BLOCK_SHAPE),
+            )
+            self.classifier.image = matrix
+            self.classifier.features = features.LazyFeatureVolume(
+                matrix, store=store, computed=computed
             )
 
     def SetUp(self):
         self._create_mask()
+        self.markers = self.classifier.get_markers(self.matrix, (BRUSH_FOREGROUND,))
         self.viewer.slice_.to_show_aux = "classify"
         self.viewer.slice_.aux_matrices_colours[self.viewer.slice_.to_show_aux] = {
             BRUSH_ERASE: (0.0, 0.0, 0.0, 0.0),
@@ -169,34 +191,99 @@ class ClassificationStyle(styles.BaseImageEditionInteractorStyle):
         else:
             self.fill_value = BRUSH_FOREGROUND
 
+    def edit_mask_pixel(self, fill_value, n, index, position, radius, orientation):
+        self.markers.mark_dirty(orientation, n)
+        super().edit_mask_pixel(fill_value, n, index, position, radius, orientation)
+
     def after_brush_release(self):
-        n = self.viewer.slice_data.number
-        lbp_image = self.classifier.lbp_image
+        index, old, new = self.markers.get_changes()
+        lbp_image = self.classifier.features
         mask = self.matrix
-        marked_values = lbp_image[mask == BRUSH_FOREGROUND]
+        marked = self.markers.get_voxels(BRUSH_FOREGROUND)
+        current_mask = self.viewer.slice_.current_mask
+        if marked.size == 0:
+            # All the markers were erased, so is the region grown from them.
+            erased = (old == BRUSH_FOREGROUND).any()
+            if erased and current_mask is self.classifier.mask:
+                self.write_region(np.zeros_like(mask))
+            return
+        marked_values = lbp_image.get_values(marked)
         mean_lbp = marked_values.mean(0, dtype=np.float32)
         dists = np.linalg.norm(marked_values - mean_lbp, axis=1)
         std_dist = dists.mean()
         strct = np.array(generate_binary_structure(3, 1), dtype=np.uint8)
         print(mean_lbp, std_dist)
-        print("BEFORE MARKED", (mask == BRUSH_FOREGROUND).sum())
-        out = floodfill.texture_floodfill(
-            lbp_image, mask, mean_lbp, BRUSH_FOREGROUND, std_dist, strct
+
+        erased = ((old == BRUSH_FOREGROUND) & (new != BRUSH_FOREGROUND)).any()
+        if (
+            erased
+            or current_mask is not self.classifier.mask
+            or not is_all_edited(current_mask.matrix)
+        ):
+            self.classifier.mask = current_mask
+            bbox = markers.get_index_bbox(marked, mask.shape)
+            self.full_floodfill(mean_lbp, std_dist, strct, bbox)
+            return
+
+        # Only grows from the new markers that are not in the region yet,
+        # writing directly in the mask.
+        image_mask = current_mask.matrix[1:, 1:, 1:]
+        seeds = np.unravel_index(index[new == BRUSH_FOREGROUND], mask.shape)
+        seeds = tuple(i[image_mask[seeds] != 255] for i in seeds)
+        changed = features.texture_floodfill_inplace(
+            lbp_image,
+            seeds,
+            mean_lbp,
+            255,
+            std_dist,
+            strct,
+            image_mask,
+            confidence=self.config.confidence or 0,
         )
-        print("AFTER MARKED", (out == BRUSH_FOREGROUND).sum())
+        if changed is not None:
+            self.reload_mask(changed)
+
+    def reload_mask(self, bbox=None):
+        self.viewer.slice_.current_mask.was_edited = True
+        if slice_buffers.discard_buffers(self.viewer.slice_, bbox):
+            Publisher.sendMessage("Reload actual slice")
+
+    def full_floodfill(self, mean_lbp, std_dist, strct, bbox):
+        out = features.texture_floodfill(
+            self.classifier.features,
+            self.matrix,
+            mean_lbp,
+            BRUSH_FOREGROUND,
+            std_dist,
+            strct,
+            bbox=bbox,
+            confidence=self.config.confidence or 0,
+        )
+        self.write_region(out)
+
+    def write_region(self, out):
         image_mask = self.viewer.slice_.current_mask.matrix
-        image_mask[1:, 1:, 1:] = out * 255
+        out *= 255
+        # The slices not edited yet are shown thresholded, they all have to be
+        # redrawn when marked as edited.
+        if is_all_edited(image_mask):
+            changed = features.get_bbox(image_mask[1:, 1:, 1:] != out)
+            if changed is None:
+                return
+        else:
+            changed = None
+        image_mask[1:, 1:, 1:] = out
         image_mask[0] = 255
         image_mask[:, 0, :] = 255
         image_mask[:, :, 0] = 255
+        self.reload_mask(changed)
 
-        self.viewer.slice_.buffer_slices["AXIAL"].discard_mask()
-        self.viewer.slice_.buffer_slices["CORONAL"].discard_mask()
-        self.viewer.slice_.buffer_slices["SAGITAL"].discard_mask()
-
-        self.viewer.slice_.buffer_slices["AXIAL"].discard_vtk_mask()
-        self.viewer.slice_.buffer_slices["CORONAL"].discard_vtk_mask()
-        self.viewer.slice_.buffer_slices["SAGITAL"].discard_vtk_mask()
 
-        self.viewer.slice_.current_mask.was_edited = True
-        Publisher.sendMessage("Reload actual slice")
+def is_all_edited(matrix):
+    # The first voxel of each slice of the mask marks the slices already
+    # edited (not thresholded).
+    return (
+        (matrix[0] == 255).all()
+        and (matrix[:, 0, :] == 255).all()
+        and (matrix[:, :, 0] == 255).all()
+    )
@@ -0,0 +1,318 @@
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from . import floodfill
+from . import simple_lbp
+
+SIGMA = 1.5
+BLOCK_SHAPE = (32, 64, 64)
+MAX_CACHE_MEMORY = 1024**3
+ROI_MARGIN = 16
+
+
+def get_bbox(mask):
+    """
+    Returns the slices of the bounding box of the non zero voxels of mask or
+    None if mask is empty.
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(i for i in range(mask.ndim) if i != axis)
+        (idx,) = np.nonzero(mask.any(axis=other))
+        if idx.size == 0:
+            return None
+        bbox.append(slice(int(idx[0]), int(idx[-1]) + 1))
+    return tuple(bbox)
+
+
+def get_nblocks(shape, block_shape=BLOCK_SHAPE):
+    return tuple((size + b - 1) // b for size, b in zip(shape, block_shape))
+
+
+def expand_bbox(bbox, margin, shape):
+    return tuple(
+        slice(max(0, s.start - margin), min(size, s.stop + margin))
+        for s, size in zip(bbox, shape)
+    )
+
+
+class LazyFeatureVolume:
+    """
+    Gaussian smoothing + LBP codes of image computed in blocks only when they
+    are accessed. Each block is computed over the block plus a halo big enough
+    to give the same values as filtering the whole volume. Computed blocks are
+    kept in a LRU cache limited to max_memory bytes, or written to store (a
+    (dz, dy, dx, 3) memmap) when given, with computed flagging the blocks
+    already in there.
+    """
+
+    def __init__(
+        self,
+        image,
+        sigma=SIGMA,
+        block_shape=BLOCK_SHAPE,
+        max_memory=MAX_CACHE_MEMORY,
+        store=None,
+        computed=None,
+    ):
+        self.image = image
+        self.shape = image.shape
+        self.sigma = sigma
+        self.block_shape = tuple(block_shape)
+        self.max_memory = max_memory
+        # gaussian_filter radius (truncate=4.0) + the LBP neighbourhood.
+        self.halo = int(4.0 * sigma + 0.5) + 1
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.store = store
+        if store is not None and computed is None:
+            computed = np.zeros(get_nblocks(self.shape, self.block_shape), np.uint8)
+        self.computed = computed
+
+    def __getitem__(self, bbox):
+        """
+        Returns the (dz, dy, dx, 3) LBP codes inside bbox, a tuple of 3 slices
+        with step 1.
+        """
+        bbox = tuple(
+            slice(*s.indices(size)[:2]) for s, size in zip(bbox, self.shape)
+        )
+        out = np.empty(
+            [s.stop - s.start for s in bbox] + [3],
+            dtype=np.uint8,
+        )
+        ranges = [
+            range(s.start // b, (s.stop - 1) // b + 1) if s.stop > s.start else ()
+            for s, b in zip(bbox, self.block_shape)
+        ]
+        for index in itertools.product(*ranges):
+            block = self.get_block(index)
+            src = []
+            dst = []
+            for s, i, b in zip(bbox, index, self.block_shape):
+                start = max(s.start, i * b)
+                stop = min(s.stop, (i + 1) * b)
+                src.append(slice(start - i * b, stop - i * b))
+                dst.append(slice(start - s.start, stop - s.start))
+            out[tuple(dst)] = block[tuple(src)]
+        return out
+
+    def get_block(self, index):
+        if self.store is not None:
+            block = self.store[self.get_block_slices(index)]
+            if not self.computed[index]:
+                block[:] = self.compute_block(index)
+                self.computed[index] = 1
+            return block
+        try:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        except KeyError:
+            pass
+        block = self.compute_block(index)
+        self.blocks[index] = block
+        self.nbytes += block.nbytes
+        while self.nbytes > self.max_memory and len(self.blocks) > 1:
+            _, old = self.blocks.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return block
+
+    def get_values(self, index):
+        """
+        Returns the (len(index), 3) LBP codes of the voxels with the given flat
+        indices, only the blocks they are in are computed.
+        """
+        index = np.asarray(index)
+        values = np.empty((index.size, 3), dtype=np.uint8)
+        nblocks = get_nblocks(self.shape, self.block_shape)
+        block_shape = np.array(self.block_shape)[:, np.newaxis]
+        coords = np.array(np.unravel_index(index, self.shape))
+        blocks = coords // block_shape
+        block_ids = np.ravel_multi_index(blocks, nblocks)
+        order = np.argsort(block_ids, kind="stable")
+        ids, starts = np.unique(block_ids[order], return_index=True)
+        for block_id, group in zip(ids, np.split(order, starts[1:])):
+            block_index = np.unravel_index(block_id, nblocks)
+            block = self.get_block(tuple(int(i) for i in block_index))
+            local = coords[:, group] - blocks[:, group[:1]] * block_shape
+            values[group] = block[tuple(local)]
+        return values
+
+    def get_block_slices(self, index):
+        return tuple(
+            slice(i * b, min((i + 1) * b, size))
+            for i, b, size in zip(index, self.block_shape, self.shape)
+        )
+
+    def compute_block(self, index):
+        inner = []
+        outer = []
+        for i, b, size in zip(index, self.block_shape, self.shape):
+            start = i * b
+            stop = min(start + b, size)
+            hstart = max(0, start - self.halo)
+            hstop = min(size, stop + self.halo)
+            outer.append(slice(hstart, hstop))
+            inner.append(slice(start - hstart, stop - hstart))
+        image = gaussian_filter(self.image[tuple(outer)], self.sigma)
+        lbp = simple_lbp.simple_lbp(image)
+        return np.ascontiguousarray(lbp[tuple(inner)])
+
+    def clear(self):
+        self.blocks.clear()
+        self.nbytes = 0
+
+
+def texture_floodfill(
+    features,
+    mask,
+    value,
+    fill,
+    max_dist,
+    strct,
+    margin=ROI_MARGIN,
+    bbox=None,
+    confidence=0,
+):
+    """
+    Runs floodfill.texture_floodfill only inside a ROI around the seeds in
+    mask, so only the features inside the ROI are computed. While the filled
+    region touches a ROI face that isn't a face of the volume the ROI is grown
+    and the floodfill is done again. The result is the same as running it in
+    the whole volume. bbox is the bounding box of the seeds, if known. If
+    confidence is given floodfill.texture_floodfill_adaptive is used.
+    """
+    out = np.zeros_like(mask)
+    if bbox is None:
+        bbox = get_bbox(mask)
+    if bbox is None:
+        return out
+    offsets = [i // 2 for i in strct.shape]
+    roi = expand_bbox(bbox, margin, mask.shape)
+    while True:
+        lbp = features[roi]
+        roi_mask = np.ascontiguousarray(mask[roi])
+        if confidence > 0:
+            roi_out = floodfill.texture_floodfill_adaptive(
+                lbp, roi_mask, value, fill, max_dist, confidence, strct
+            )
+        else:
+            roi_out = floodfill.texture_floodfill_parallel(
+                lbp, roi_mask, value, fill, max_dist, strct
+            )
+        grow = False
+        for axis, (s, size, offset) in enumerate(zip(roi, mask.shape, offsets)):
+            if offset == 0:
+                continue
+            lower = [slice(None)] * 3
+            lower[axis] = slice(0, offset)
+            upper = [slice(None)] * 3
+            upper[axis] = slice(-offset, None)
+            if (s.start > 0 and roi_out[tuple(lower)].any()) or (
+                s.stop < size and roi_out[tuple(upper)].any()
+            ):
+                grow = True
+        if not grow:
+            break
+        margin *= 2
+        roi = expand_bbox(bbox, margin, mask.shape)
+    out[roi] = roi_out
+    return out
+
+
+def _touched_faces(changed, roi, shape, offsets):
+    # Voxels set in the layers near the ROI faces that are not faces of the
+    # volume, their neighbours outside the ROI were not visited.
+    faces = np.zeros(changed.shape, dtype=bool)
+    for axis, (s, size, offset) in enumerate(zip(roi, shape, offsets)):
+        if offset == 0:
+            continue
+        if s.start > 0:
+            layer = [slice(None)] * 3
+            layer[axis] = slice(0, offset)
+            faces[tuple(layer)] = True
+        if s.stop < size:
+            layer = [slice(None)] * 3
+            layer[axis] = slice(-offset, None)
+            faces[tuple(layer)] = True
+    return changed & faces
+
+
+def texture_floodfill_inplace(
+    features,
+    seeds,
+    value,
+    fill,
+    max_dist,
+    strct,
+    out,
+    margin=ROI_MARGIN,
+    confidence=0,
+):
+    """
+    Grows the region from seeds ((z, y, x) coordinate arrays) directly into
+    out, only computing the features inside a ROI around the seeds. The
+    voxels already equal to fill in out are kept and not visited again.
+    Returns the bounding box (slices) of the voxels changed or None. If
+    confidence is given the region is grown adaptively (see
+    floodfill.texture_floodfill_adaptive).
+    """
+    seeds = tuple(np.asarray(i) for i in seeds)
+    if seeds[0].size == 0:
+        return None
+    offsets = [max(i // 2, i - 1 - i // 2) for i in strct.shape]
+    seeds_bbox = tuple(slice(int(i.min()), int(i.max()) + 1) for i in seeds)
+    roi = expand_bbox(seeds_bbox, margin, out.shape)
+    changed_bbox = None
+    while True:
+        roi_out = out[roi]
+        roi_seeds = np.zeros(roi_out.shape, dtype=np.uint8)
+        roi_seeds[tuple(i - s.start for i, s in zip(seeds, roi))] = 1
+        before = roi_out != fill
+        saved = roi_out.copy() if confidence > 0 else None
+        bbox = floodfill.texture_floodfill_inplace(
+            features[roi],
+            roi_seeds,
+            value,
+            fill,
+            max_dist,
+            strct,
+            roi_out,
+            confidence=confidence,
+        )
+        if bbox is None:
+            break
+        bbox = tuple(
+            slice(b.start + s.start, b.stop + s.start) for b, s in zip(bbox, roi)
+        )
+        changed_bbox = union_bbox(changed_bbox, bbox)
+        touched = _touched_faces(before & (roi_out == fill), roi, out.shape, offsets)
+        if not touched.any():
+            break
+        if confidence > 0:
+            # The statistics depend on the order the voxels are visited, so
+            # it's done again from the seeds in the bigger ROI.
+            roi_out[:] = saved
+        else:
+            # The region continues from the voxels at the faces of the ROI.
+            touched = np.nonzero(touched)
+            seeds = tuple(
+                np.concatenate((i, t + s.start))
+                for i, t, s in zip(seeds, touched, roi)
+            )
+        margin *= 2
+        roi = expand_bbox(seeds_bbox, margin, out.shape)
+    return changed_bbox
+
+
+def union_bbox(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return tuple(
+        slice(min(i.start, j.start), max(i.stop, j.stop)) for i, j in zip(a, b)
+    )
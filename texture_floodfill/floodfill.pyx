@@ -7,6 +7,7 @@ cimport cython
 from collections import deque
 
 from cython.parallel import prange
+cimport openmp
 from libc.math cimport floor, ceil, sqrt
 from libcpp cimport bool
 from libcpp.deque cimport deque as cdeque
@@ -21,6 +22,14 @@ cdef struct s_coord:
 
 ctypedef s_coord coord
 
+cdef struct s_span:
+    int z
+    int y
+    int x0
+    int x1
+
+ctypedef s_span span
+
 
 @cython.boundscheck(False) # turn of bounds-checking for entire function
 @cython.wraparound(False)
@@ -118,6 +127,360 @@ def texture_floodfill(np.ndarray[np.uint8_t, ndim=4] lbp_image, np.ndarray[mask_
     return out
 
 
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cdivision(True)
+cdef inline bint _texture_accept(np.uint8_t[:, :, :, :] lbp_image, float* dist_lut, float max_dist2, int z, int y, int x) nogil:
+    # Same float operations as _texture_floodfill, the squared difference of
+    # each channel is taken from a LUT.
+    return (
+        dist_lut[lbp_image[z, y, x, 0]]
+        + dist_lut[256 + lbp_image[z, y, x, 1]]
+        + dist_lut[512 + lbp_image[z, y, x, 2]]
+    ) <= max_dist2
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cdivision(True)
+cdef inline void _update_bbox(int* bbox, int z, int y, int x) nogil:
+    if z < bbox[0]: bbox[0] = z
+    if z > bbox[1]: bbox[1] = z
+    if y < bbox[2]: bbox[2] = y
+    if y > bbox[3]: bbox[3] = y
+    if x < bbox[4]: bbox[4] = x
+    if x > bbox[5]: bbox[5] = x
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cdivision(True)
+cdef void _texture_grow_slab(np.uint8_t[:, :, :, :] lbp_image, float* dist_lut, float max_dist2, mask_t fill, mask_t[:, :, :] strct, mask_t[:, :, :] out, int z0, int z1, vector[coord]& stack, vector[coord]& outbox_down, vector[coord]& outbox_up, int* bbox) nogil:
+    # Grows the region from the voxels in stack without leaving [z0, z1).
+    # The voxels reached in the other slabs are put in the outboxes.
+    cdef coord c
+    cdef int x, y, z
+    cdef int xo, yo, zo
+    cdef int i, j, k
+    cdef int dx, dy, dz
+    cdef int odx, ody, odz
+    cdef int offset_x, offset_y, offset_z
+
+    dz = out.shape[0]
+    dy = out.shape[1]
+    dx = out.shape[2]
+
+    odz = strct.shape[0]
+    ody = strct.shape[1]
+    odx = strct.shape[2]
+
+    offset_z = odz // 2
+    offset_y = ody // 2
+    offset_x = odx // 2
+
+    while stack.size():
+        c = stack.back()
+        stack.pop_back()
+
+        x = c.x
+        y = c.y
+        z = c.z
+
+        for k in range(odz):
+            zo = z + k - offset_z
+            if zo < 0 or zo >= dz:
+                continue
+            for j in range(ody):
+                yo = y + j - offset_y
+                if yo < 0 or yo >= dy:
+                    continue
+                for i in range(odx):
+                    xo = x + i - offset_x
+                    if strct[k, j, i] and 0 <= xo < dx:
+                        c.x = xo
+                        c.y = yo
+                        c.z = zo
+                        if zo < z0:
+                            outbox_down.push_back(c)
+                        elif zo >= z1:
+                            outbox_up.push_back(c)
+                        elif out[zo, yo, xo] != fill and _texture_accept(lbp_image, dist_lut, max_dist2, zo, yo, xo):
+                            out[zo, yo, xo] = fill
+                            _update_bbox(bbox, zo, yo, xo)
+                            stack.push_back(c)
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cdivision(True)
+cdef int _texture_take_outbox(np.uint8_t[:, :, :, :] lbp_image, float* dist_lut, float max_dist2, mask_t fill, mask_t[:, :, :] out, vector[coord]& outbox, vector[coord]& stack, int* bbox) nogil:
+    cdef coord c
+    cdef size_t n
+    cdef int added = 0
+    for n in range(outbox.size()):
+        c = outbox[n]
+        if out[c.z, c.y, c.x] != fill and _texture_accept(lbp_image, dist_lut, max_dist2, c.z, c.y, c.x):
+            out[c.z, c.y, c.x] = fill
+            _update_bbox(bbox, c.z, c.y, c.x)
+            stack.push_back(c)
+            added += 1
+    return added
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cdivision(True)
+cdef void _texture_collect_seeds(mask_t[:, :, :] seeds, mask_t fill, mask_t[:, :, :] out, int z0, int z1, vector[coord]& stack, int* bbox) nogil:
+    cdef coord c
+    cdef int x, y, z
+    for z in range(z0, z1):
+        for y in range(seeds.shape[1]):
+            for x in range(seeds.shape[2]):
+                if seeds[z, y, x]:
+                    if out[z, y, x] != fill:
+                        out[z, y, x] = fill
+                        _update_bbox(bbox, z, y, x)
+                    c.x = x
+                    c.y = y
+                    c.z = z
+                    stack.push_back(c)
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cdivision(True)
+cdef void _texture_floodfill_parallel(np.uint8_t[:, :, :, :] lbp_image, mask_t[:, :, :] seeds, np.float32_t[:] value, mask_t fill, float max_dist, mask_t[:, :, :] strct, mask_t[:, :, :] out, int slab_size, int* bbox):
+    # Grows the region in Z slabs, each one in a thread. The voxels a slab
+    # reaches in the neighbour slabs are given to them in the next round,
+    # until no slab grows anymore. bbox (z0, z1, y0, y1, x0, x1, inclusive)
+    # is set to the bounding box of the voxels that were set to fill.
+    cdef float dist_lut[768]
+    cdef float d, max_dist2
+    cdef int x
+    cdef int dx, dy, dz
+    cdef int i, s, nslabs, min_slab_size, nthreads
+    cdef int added
+
+    cdef vector[vector[coord]] stacks
+    cdef vector[vector[coord]] outbox_down
+    cdef vector[vector[coord]] outbox_up
+    cdef vector[int] slab_bbox
+
+    dz = out.shape[0]
+    dy = out.shape[1]
+    dx = out.shape[2]
+
+    for s in range(3):
+        for x in range(256):
+            d = value[s] - x
+            dist_lut[s * 256 + x] = d * d
+    max_dist2 = max_dist * max_dist
+
+    # A slab can only send voxels to the slabs right above and below it.
+    min_slab_size = max(1, strct.shape[0] // 2, strct.shape[0] - 1 - strct.shape[0] // 2)
+    if slab_size <= 0:
+        nthreads = 4 * openmp.omp_get_max_threads()
+        slab_size = (dz + nthreads - 1) // nthreads
+    slab_size = max(slab_size, min_slab_size)
+    nslabs = (dz + slab_size - 1) // slab_size
+
+    stacks.resize(nslabs)
+    outbox_down.resize(nslabs)
+    outbox_up.resize(nslabs)
+    slab_bbox.resize(6 * nslabs)
+    for s in range(nslabs):
+        slab_bbox[6 * s + 0] = dz
+        slab_bbox[6 * s + 1] = -1
+        slab_bbox[6 * s + 2] = dy
+        slab_bbox[6 * s + 3] = -1
+        slab_bbox[6 * s + 4] = dx
+        slab_bbox[6 * s + 5] = -1
+
+    with nogil:
+        for s in prange(nslabs, schedule="dynamic"):
+            _texture_collect_seeds(seeds, fill, out, s * slab_size, min((s + 1) * slab_size, dz), stacks[s], &slab_bbox[6 * s])
+
+        while True:
+            for s in prange(nslabs, schedule="dynamic"):
+                outbox_down[s].clear()
+                outbox_up[s].clear()
+                _texture_grow_slab(lbp_image, dist_lut, max_dist2, fill, strct, out, s * slab_size, min((s + 1) * slab_size, dz), stacks[s], outbox_down[s], outbox_up[s], &slab_bbox[6 * s])
+
+            added = 0
+            for s in prange(nslabs, schedule="dynamic"):
+                if s > 0:
+                    added += _texture_take_outbox(lbp_image, dist_lut, max_dist2, fill, out, outbox_up[s - 1], stacks[s], &slab_bbox[6 * s])
+                if s < nslabs - 1:
+                    added += _texture_take_outbox(lbp_image, dist_lut, max_dist2, fill, out, outbox_down[s + 1], stacks[s], &slab_bbox[6 * s])
+
+            if added == 0:
+                break
+
+    bbox[0] = dz
+    bbox[1] = -1
+    bbox[2] = dy
+    bbox[3] = -1
+    bbox[4] = dx
+    bbox[5] = -1
+    for s in range(nslabs):
+        for i in range(0, 6, 2):
+            bbox[i] = min(bbox[i], slab_bbox[6 * s + i])
+            bbox[i + 1] = max(bbox[i + 1], slab_bbox[6 * s + i + 1])
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+@cython.cdivision(True)
+cdef void _texture_floodfill_adaptive(np.uint8_t[:, :, :, :] lbp_image, mask_t[:, :, :] seeds, np.float32_t[:] value, mask_t fill, float max_dist, float confidence, mask_t[:, :, :] strct, mask_t[:, :, :] out, int* bbox) nogil:
+    # Grows the region breadth first from the seeds, updating the region mean
+    # and spread (mean squared distance to the mean) with each voxel accepted
+    # (Welford). A voxel is accepted if its distance to the mean is at most
+    # confidence times the spread. The seeds start the statistics with value
+    # as mean and max_dist as spread.
+    cdef cdeque[coord] queue
+    cdef coord c
+    cdef int x, y, z
+    cdef int xo, yo, zo
+    cdef int i, j, k, s
+    cdef int dx, dy, dz
+    cdef int odx, ody, odz
+    cdef int offset_x, offset_y, offset_z
+    cdef double mean[3]
+    cdef double n, m2, dist2, delta, confidence2
+
+    dz = out.shape[0]
+    dy = out.shape[1]
+    dx = out.shape[2]
+
+    odz = strct.shape[0]
+    ody = strct.shape[1]
+    odx = strct.shape[2]
+
+    offset_z = odz // 2
+    offset_y = ody // 2
+    offset_x = odx // 2
+
+    bbox[0] = dz
+    bbox[1] = -1
+    bbox[2] = dy
+    bbox[3] = -1
+    bbox[4] = dx
+    bbox[5] = -1
+
+    n = 0
+    for z in range(dz):
+        for y in range(dy):
+            for x in range(dx):
+                if seeds[z, y, x]:
+                    if out[z, y, x] != fill:
+                        out[z, y, x] = fill
+                        _update_bbox(bbox, z, y, x)
+                    c.x = x
+                    c.y = y
+                    c.z = z
+                    queue.push_back(c)
+                    n += 1
+    if n == 0:
+        return
+
+    for s in range(3):
+        mean[s] = value[s]
+    m2 = n * max_dist * max_dist
+    confidence2 = confidence * confidence
+
+    while queue.size():
+        c = queue.front()
+        queue.pop_front()
+
+        x = c.x
+        y = c.y
+        z = c.z
+
+        for k in range(odz):
+            zo = z + k - offset_z
+            if zo < 0 or zo >= dz:
+                continue
+            for j in range(ody):
+                yo = y + j - offset_y
+                if yo < 0 or yo >= dy:
+                    continue
+                for i in range(odx):
+                    xo = x + i - offset_x
+                    if strct[k, j, i] and 0 <= xo < dx and out[zo, yo, xo] != fill:
+                        dist2 = 0
+                        for s in range(3):
+                            delta = lbp_image[zo, yo, xo, s] - mean[s]
+                            dist2 += delta * delta
+                        if dist2 * n <= confidence2 * m2:
+                            out[zo, yo, xo] = fill
+                            _update_bbox(bbox, zo, yo, xo)
+                            c.x = xo
+                            c.y = yo
+                            c.z = zo
+                            queue.push_back(c)
+                            n += 1
+                            for s in range(3):
+                                delta = lbp_image[zo, yo, xo, s] - mean[s]
+                                mean[s] += delta / n
+                                m2 += delta * (lbp_image[zo, yo, xo, s] - mean[s])
+
+
+def texture_floodfill_adaptive(np.uint8_t[:, :, :, :] lbp_image, mask_t[:, :, :] mask, np.float32_t[:] value, mask_t fill, float max_dist, float confidence, mask_t[:, :, :] strct):
+    """
+    Like texture_floodfill, but value and max_dist are only the initial mean
+    and spread of the region, they are updated as the region grows and the
+    voxels are accepted within confidence times the spread of the region.
+    The result depends on the visiting order, the region is grown breadth
+    first from the seeds in a single thread.
+    """
+    cdef mask_t[:, :, :] out = np.zeros_like(mask)
+    cdef int bbox[6]
+    with nogil:
+        _texture_floodfill_adaptive(lbp_image, mask, value, fill, max_dist, confidence, strct, out, bbox)
+    return np.asarray(out)
+
+
+def texture_floodfill_parallel(np.ndarray[np.uint8_t, ndim=4] lbp_image, np.ndarray[mask_t, ndim=3] mask, np.ndarray[np.float32_t, ndim=1] value, mask_t fill, float max_dist, np.ndarray[mask_t, ndim=3] strct, int slab_size=0):
+    """
+    Same result as texture_floodfill, but the region is grown in parallel
+    in Z slabs without the GIL.
+    """
+    cdef np.ndarray[mask_t, ndim=3] out = np.zeros_like(mask)
+    cdef int bbox[6]
+    _texture_floodfill_parallel(lbp_image, mask, value, fill, max_dist, strct, out, slab_size, bbox)
+    return out
+
+
+def texture_floodfill_inplace(np.uint8_t[:, :, :, :] lbp_image, mask_t[:, :, :] seeds, np.float32_t[:] value, mask_t fill, float max_dist, mask_t[:, :, :] strct, mask_t[:, :, :] out, int slab_size=0, float confidence=0):
+    """
+    Grows the region from seeds directly into out (which may be a view of a
+    bigger array). The voxels already equal to fill in out are not visited
+    again, so only the new part of the region is computed. Returns the
+    bounding box (slices) of the voxels set to fill or None. If confidence
+    is given the region is grown as in texture_floodfill_adaptive.
+    """
+    cdef int bbox[6]
+    if confidence > 0:
+        with nogil:
+            _texture_floodfill_adaptive(lbp_image, seeds, value, fill, max_dist, confidence, strct, out, bbox)
+    else:
+        _texture_floodfill_parallel(lbp_image, seeds, value, fill, max_dist, strct, out, slab_size, bbox)
+    if bbox[1] < 0:
+        return None
+    return (
+        slice(bbox[0], bbox[1] + 1),
+        slice(bbox[2], bbox[3] + 1),
+        slice(bbox[4], bbox[5] + 1),
+    )
+
+
 @cython.boundscheck(False) # turn of bounds-checking for entire function
 def floodfill(np.ndarray[image_t, ndim=3] data, int i, int j, int k, int v, int fill, np.ndarray[mask_t, ndim=3] out):
 
@@ -312,6 +675,238 @@ def floodfill_auto_threshold(np.ndarray[image_t, ndim=3] data, list seeds, float
         return out
 
 
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef int _threshold_span(image_t[:, :, :] data, int t0, int t1, mask_t fill, mask_t[:, :, :] out, int z, int y, int x, vector[span]& stack) nogil:
+    # Fills the run along X of voxels inside the threshold from x and pushes
+    # it. Returns the end of the run.
+    cdef span s
+    cdef int x0 = x
+    cdef int x1 = x
+    cdef int dx = out.shape[2]
+    while x0 > 0 and out[z, y, x0 - 1] != fill and t0 <= data[z, y, x0 - 1] <= t1:
+        x0 -= 1
+    while x1 < dx - 1 and out[z, y, x1 + 1] != fill and t0 <= data[z, y, x1 + 1] <= t1:
+        x1 += 1
+    for x in range(x0, x1 + 1):
+        out[z, y, x] = fill
+    s.z = z
+    s.y = y
+    s.x0 = x0
+    s.x1 = x1
+    stack.push_back(s)
+    return x1
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef void _floodfill_threshold_scanline(image_t[:, :, :] data, int t0, int t1, mask_t fill, mask_t[:, :, :] strct, mask_t[:, :, :] out, vector[span]& stack) nogil:
+    cdef span s
+    cdef int x, xo, yo, zo
+    cdef int i, j, k, r
+    cdef int dx, dy, dz
+    cdef int odx, ody, odz
+    cdef int offset_x, offset_y, offset_z
+    cdef int start, stop
+    cdef bint neighbour
+
+    # First and last X offset of each row of strct and if the offsets between
+    # them are all set.
+    cdef vector[int] row_min
+    cdef vector[int] row_max
+    cdef vector[int] row_contiguous
+
+    dz = data.shape[0]
+    dy = data.shape[1]
+    dx = data.shape[2]
+
+    odz = strct.shape[0]
+    ody = strct.shape[1]
+    odx = strct.shape[2]
+
+    offset_z = odz / 2
+    offset_y = ody / 2
+    offset_x = odx / 2
+
+    row_min.resize(odz * ody, odx)
+    row_max.resize(odz * ody, -1)
+    row_contiguous.resize(odz * ody, 1)
+    for k in range(odz):
+        for j in range(ody):
+            r = k * ody + j
+            for i in range(odx):
+                if strct[k, j, i]:
+                    if row_max[r] >= 0 and i != row_max[r] + 1:
+                        row_contiguous[r] = 0
+                    if row_min[r] > i:
+                        row_min[r] = i
+                    row_max[r] = i
+
+    while stack.size():
+        s = stack.back()
+        stack.pop_back()
+
+        for k in range(odz):
+            zo = s.z + k - offset_z
+            if zo < 0 or zo >= dz:
+                continue
+            for j in range(ody):
+                yo = s.y + j - offset_y
+                r = k * ody + j
+                if yo < 0 or yo >= dy or row_max[r] < 0:
+                    continue
+                start = max(0, s.x0 + row_min[r] - offset_x)
+                stop = min(dx - 1, s.x1 + row_max[r] - offset_x)
+                x = start
+                while x <= stop:
+                    if out[zo, yo, x] != fill and t0 <= data[zo, yo, x] <= t1:
+                        neighbour = row_contiguous[r]
+                        if not neighbour:
+                            for i in range(odx):
+                                xo = x - i + offset_x
+                                if strct[k, j, i] and s.x0 <= xo <= s.x1:
+                                    neighbour = True
+                                    break
+                        if neighbour:
+                            x = _threshold_span(data, t0, t1, fill, out, zo, yo, x, stack)
+                    x += 1
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def floodfill_threshold_scanline(np.ndarray[image_t, ndim=3] data, list seeds, int t0, int t1, int fill, np.ndarray[mask_t, ndim=3] strct, np.ndarray[mask_t, ndim=3] out):
+    """
+    Same result as floodfill_threshold, but runs of voxels along X are filled
+    and pushed at once instead of each voxel. strct must connect each voxel
+    to its X neighbours, else floodfill_threshold is used.
+    """
+    cdef int to_return = 0
+    if out is None:
+        out = np.zeros_like(data)
+        to_return = 1
+
+    cdef int i, j, k
+    cdef int oz = strct.shape[0] / 2
+    cdef int oy = strct.shape[1] / 2
+    cdef int ox = strct.shape[2] / 2
+    if ox == 0 or ox == strct.shape[2] - 1 or not (strct[oz, oy, ox - 1] and strct[oz, oy, ox + 1]):
+        floodfill_threshold(data, seeds, t0, t1, fill, strct, out)
+        if to_return:
+            return out
+        return
+
+    cdef image_t[:, :, :] data_v = data
+    cdef mask_t[:, :, :] strct_v = strct
+    cdef mask_t[:, :, :] out_v = out
+    cdef vector[span] stack
+
+    for i, j, k in seeds:
+        if data[k, j, i] >= t0 and data[k, j, i] <= t1:
+            _threshold_span(data_v, t0, t1, fill, out_v, k, j, i, stack)
+
+    with nogil:
+        _floodfill_threshold_scanline(data_v, t0, t1, fill, strct_v, out_v, stack)
+
+    if to_return:
+        return out
+
+
+cdef inline bint _in_auto_threshold(image_t v, image_t u, float p) nogil:
+    # The same thresholds floodfill_auto_threshold uses from v.
+    return <int>ceil(v * (1 - p)) <= u <= <int>floor(v * (1 + p))
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef int _auto_threshold_span(image_t[:, :, :] data, float p, mask_t fill, mask_t[:, :, :] out, int z, int y, int x, vector[span]& stack) nogil:
+    # Fills the run along X reached from x, each voxel inside the thresholds
+    # of the previous one, and pushes it. Returns the end of the run.
+    cdef span s
+    cdef int x0 = x
+    cdef int x1 = x
+    cdef int dx = out.shape[2]
+    while x0 > 0 and out[z, y, x0 - 1] != fill and _in_auto_threshold(data[z, y, x0], data[z, y, x0 - 1], p):
+        x0 -= 1
+    while x1 < dx - 1 and out[z, y, x1 + 1] != fill and _in_auto_threshold(data[z, y, x1], data[z, y, x1 + 1], p):
+        x1 += 1
+    for x in range(x0, x1 + 1):
+        out[z, y, x] = fill
+    s.z = z
+    s.y = y
+    s.x0 = x0
+    s.x1 = x1
+    stack.push_back(s)
+    return x1
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+cdef void _floodfill_auto_threshold_scanline(image_t[:, :, :] data, float p, mask_t fill, mask_t[:, :, :] out, vector[span]& stack) nogil:
+    cdef span s
+    cdef int x, yo, zo, n
+    cdef int dy, dz
+
+    dz = data.shape[0]
+    dy = data.shape[1]
+
+    while stack.size():
+        s = stack.back()
+        stack.pop_back()
+
+        # The rows above and below in Z and Y, the X neighbours are in the run.
+        for n in range(4):
+            zo = s.z
+            yo = s.y
+            if n == 0:
+                zo = s.z - 1
+            elif n == 1:
+                zo = s.z + 1
+            elif n == 2:
+                yo = s.y - 1
+            else:
+                yo = s.y + 1
+            if zo < 0 or zo >= dz or yo < 0 or yo >= dy:
+                continue
+            x = s.x0
+            while x <= s.x1:
+                if out[zo, yo, x] != fill and _in_auto_threshold(data[s.z, s.y, x], data[zo, yo, x], p):
+                    x = _auto_threshold_span(data, p, fill, out, zo, yo, x, stack)
+                x += 1
+
+
+@cython.boundscheck(False) # turn of bounds-checking for entire function
+@cython.wraparound(False)
+@cython.nonecheck(False)
+def floodfill_auto_threshold_scanline(np.ndarray[image_t, ndim=3] data, list seeds, float p, int fill, np.ndarray[mask_t, ndim=3] out):
+    """
+    Same result as floodfill_auto_threshold, but runs of voxels along X are
+    filled and pushed at once instead of each voxel.
+    """
+    cdef int to_return = 0
+    if out is None:
+        out = np.zeros_like(data)
+        to_return = 1
+
+    cdef int i, j, k
+    cdef image_t[:, :, :] data_v = data
+    cdef mask_t[:, :, :] out_v = out
+    cdef vector[span] stack
+
+    for i, j, k in seeds:
+        _auto_threshold_span(data_v, p, fill, out_v, k, j, i, stack)
+
+    with nogil:
+        _floodfill_auto_threshold_scanline(data_v, p, fill, out_v, stack)
+
+    if to_return:
+        return out
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.nonecheck(False)
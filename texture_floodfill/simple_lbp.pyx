@@ -7,6 +7,11 @@ from cython.parallel import prange
 
 from cy_my_types cimport image_t, mask_t
 
+cdef int[8] POSITIONS_A = [-1, 0, 1, 1, 1, 0, -1, -1]
+cdef int[8] POSITIONS_B = [1, 1, 1, 0, -1, -1, -1, 0]
+cdef int[8] POWERS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+
 @cython.boundscheck(False) # turn of bounds-checking for entire function
 @cython.cdivision(True)
 @cython.wraparound(False)
@@ -75,11 +80,125 @@ cdef void _cy_simple_lbp(image_t[:, :, :] image, np.uint8_t[:, :, :, :] out) nog
                             out[z, y, x, 2] += powers[i]
 
 
+DEF TILE_Z = 8
+DEF TILE_Y = 32
+
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+@cython.wraparound(False)
+cdef inline void _lbp_border(image_t[:, :, :] image, np.uint8_t[:, :, :, :] out, int z, int y, int x) nogil:
+    # Same as _cy_simple_lbp for one voxel: neighbours outside the image
+    # don't set their bit.
+    cdef int dx, dy, dz
+    cdef int lx, ly, lz
+    cdef int i
+    cdef np.uint8_t axial = 0, coronal = 0, sagital = 0
+    cdef image_t v = image[z, y, x]
+    dz = image.shape[0]
+    dy = image.shape[1]
+    dx = image.shape[2]
+    for i in range(8):
+        lx = x + POSITIONS_A[i]
+        ly = y + POSITIONS_B[i]
+        if 0 <= ly < dy and 0 <= lx < dx and image[z, ly, lx] >= v:
+            axial += POWERS[i]
+
+        lz = z + POSITIONS_B[i]
+        if 0 <= lz < dz and 0 <= lx < dx and image[lz, y, lx] >= v:
+            coronal += POWERS[i]
+
+        ly = y + POSITIONS_A[i]
+        if 0 <= lz < dz and 0 <= ly < dy and image[lz, ly, x] >= v:
+            sagital += POWERS[i]
+
+    out[z, y, x, 0] = axial
+    out[z, y, x, 1] = coronal
+    out[z, y, x, 2] = sagital
+
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+@cython.wraparound(False)
+cdef inline void _lbp_interior(image_t[:, :, :] image, np.uint8_t[:, :, :, :] out, int z, int y, int x) nogil:
+    # All the 24 neighbours are inside the image, no bounds checking.
+    cdef image_t v = image[z, y, x]
+    out[z, y, x, 0] = (
+        (image[z, y + 1, x - 1] >= v)
+        | (image[z, y + 1, x] >= v) << 1
+        | (image[z, y + 1, x + 1] >= v) << 2
+        | (image[z, y, x + 1] >= v) << 3
+        | (image[z, y - 1, x + 1] >= v) << 4
+        | (image[z, y - 1, x] >= v) << 5
+        | (image[z, y - 1, x - 1] >= v) << 6
+        | (image[z, y, x - 1] >= v) << 7
+    )
+    out[z, y, x, 1] = (
+        (image[z + 1, y, x - 1] >= v)
+        | (image[z + 1, y, x] >= v) << 1
+        | (image[z + 1, y, x + 1] >= v) << 2
+        | (image[z, y, x + 1] >= v) << 3
+        | (image[z - 1, y, x + 1] >= v) << 4
+        | (image[z - 1, y, x] >= v) << 5
+        | (image[z - 1, y, x - 1] >= v) << 6
+        | (image[z, y, x - 1] >= v) << 7
+    )
+    out[z, y, x, 2] = (
+        (image[z + 1, y - 1, x] >= v)
+        | (image[z + 1, y, x] >= v) << 1
+        | (image[z + 1, y + 1, x] >= v) << 2
+        | (image[z, y + 1, x] >= v) << 3
+        | (image[z - 1, y + 1, x] >= v) << 4
+        | (image[z - 1, y, x] >= v) << 5
+        | (image[z - 1, y - 1, x] >= v) << 6
+        | (image[z, y - 1, x] >= v) << 7
+    )
+
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+@cython.wraparound(False)
+cdef void _cy_simple_lbp_tiled(image_t[:, :, :] image, np.uint8_t[:, :, :, :] out) nogil:
+    # The volume is split in tiles of TILE_Z x TILE_Y rows so each thread
+    # works on neighbour rows that are still in cache. Only the voxels in the
+    # border of the image need bounds checking.
+    cdef int x, y, z
+    cdef int dx, dy, dz
+    cdef int y0, y1, z0, z1
+    cdef int t, ntiles_y, ntiles_z
+    dz = image.shape[0]
+    dy = image.shape[1]
+    dx = image.shape[2]
+
+    ntiles_z = (dz + TILE_Z - 1) // TILE_Z
+    ntiles_y = (dy + TILE_Y - 1) // TILE_Y
+
+    for t in prange(ntiles_z * ntiles_y, schedule="dynamic"):
+        z0 = (t // ntiles_y) * TILE_Z
+        z1 = z0 + TILE_Z
+        if z1 > dz:
+            z1 = dz
+        y0 = (t % ntiles_y) * TILE_Y
+        y1 = y0 + TILE_Y
+        if y1 > dy:
+            y1 = dy
+        for z in range(z0, z1):
+            for y in range(y0, y1):
+                if z == 0 or z == dz - 1 or y == 0 or y == dy - 1 or dx < 3:
+                    for x in range(dx):
+                        _lbp_border(image, out, z, y, x)
+                else:
+                    _lbp_border(image, out, z, y, 0)
+                    for x in range(1, dx - 1):
+                        _lbp_interior(image, out, z, y, x)
+                    _lbp_border(image, out, z, y, dx - 1)
+
+
 def cy_simple_lbp(image_t[:, :, :] image, np.uint8_t[:, :, :, :] out):
     return _cy_simple_lbp(image, out)
 
 
-def simple_lbp(np.ndarray[image_t, ndim=3] image):
+def simple_lbp_naive(np.ndarray[image_t, ndim=3] image):
     cdef np.ndarray[np.uint8_t, ndim=4] out
     cdef dx, dy, dz
     dz = image.shape[0]
@@ -88,3 +207,27 @@ def simple_lbp(np.ndarray[image_t, ndim=3] image):
     out = np.zeros(shape=(dz, dy, dx, 3), dtype=np.uint8)
     cy_simple_lbp(image, out)
     return out
+
+
+def simple_lbp(np.ndarray[image_t, ndim=3] image, out=None):
+    """
+    Returns the (dz, dy, dx, 3) axial, coronal and sagital LBP codes of image.
+    out may be given to write the codes into an already allocated array (a
+    memmap, for example).
+    """
+    cdef dx, dy, dz
+    cdef image_t[:, :, :] image_view = image
+    cdef np.uint8_t[:, :, :, :] out_view
+    dz = image.shape[0]
+    dy = image.shape[1]
+    dx = image.shape[2]
+    if out is None:
+        out = np.empty(shape=(dz, dy, dx, 3), dtype=np.uint8)
+    elif out.shape != (dz, dy, dx, 3) or out.dtype != np.uint8:
+        raise ValueError(
+            "out must be a uint8 array with shape %s" % ((dz, dy, dx, 3),)
+        )
+    out_view = out
+    with nogil:
+        _cy_simple_lbp_tiled(image_view, out_view)
+    return out
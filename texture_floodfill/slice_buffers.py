@@ -0,0 +1,18 @@
+ORIENTATIONS = ("AXIAL", "CORONAL", "SAGITAL")
+
+
+def discard_buffers(slice_, bbox=None):
+    """
+    Discards the mask of the buffered slices (the ones being shown) that
+    intersect bbox, (z, y, x) slices in image coordinates. All of them are
+    discarded if bbox is None. Returns True if any was discarded, else there
+    is nothing to redraw.
+    """
+    discarded = False
+    for axis, orientation in enumerate(ORIENTATIONS):
+        buffer_ = slice_.buffer_slices[orientation]
+        if bbox is None or bbox[axis].start <= buffer_.index < bbox[axis].stop:
+            buffer_.discard_mask()
+            buffer_.discard_vtk_mask()
+            discarded = True
+    return discarded